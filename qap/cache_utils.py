@@ -0,0 +1,247 @@
+# cache_utils.py
+#
+# Keys of the resources QAP keeps in a subject's output directory: every
+# resource is recorded in a manifest with a key built from the digests of
+# the subject's input files, the pipeline settings it depends on and the
+# QAP version, and is only reused while that key still matches.
+
+import os
+import os.path as op
+
+
+MANIFEST_NAME = "qap_cache.json"
+
+# preprocessing settings shared by the functional resources
+_FUNC_SETTINGS = ["start_idx", "stop_idx", "slice_timing_correction",
+                  "use_bet"]
+
+# the pipeline settings each resource depends on, including the settings
+# of the resources it is derived from
+STAGE_SETTINGS = {
+    "anatomical_reorient": [],
+    "anatomical_brain": [],
+    "flirt_affine_xfm": ["template_brain_for_anat"],
+    "flirt_linear_warped_image": ["template_brain_for_anat"],
+    "ants_rigid_xfm": ["template_brain_for_anat"],
+    "anatomical_gm_mask": ["template_brain_for_anat"],
+    "anatomical_wm_mask": ["template_brain_for_anat"],
+    "anatomical_csf_mask": ["template_brain_for_anat"],
+    "qap_head_mask": ["template_brain_for_anat", "template_skull_for_anat"],
+    "func_motion_correct": _FUNC_SETTINGS,
+    "coordinate_transformation": _FUNC_SETTINGS,
+    "mcflirt_rel_rms": _FUNC_SETTINGS,
+    "functional_brain_mask": _FUNC_SETTINGS,
+    "mean_functional": _FUNC_SETTINGS,
+    "qap_anatomical_spatial": ["template_brain_for_anat",
+                               "template_skull_for_anat", "fwhm_method",
+                               "calculate_qi2", "measures"],
+    "qap_functional_spatial": _FUNC_SETTINGS + ["ghost_direction",
+                                                "fwhm_method", "measures"],
+    "qap_functional_temporal": _FUNC_SETTINGS + ["outlier_method",
+                                                 "quality_method",
+                                                 "measures"]
+}
+
+# settings that only decide how and where QAP runs, never its results;
+# resources missing from STAGE_SETTINGS depend on every other setting
+RUN_SETTINGS = ["num_cores_per_subject", "num_subjects_at_once",
+                "num_cores_total", "memory_budget_gb", "output_directory",
+                "working_directory", "write_all_outputs", "write_report",
+                "write_graph", "image_cache_mb", "dvars_block_size",
+                "pipeline_config_yaml", "subject_id", "session_id",
+                "scan_id", "run_name", "site_name"]
+
+# the defaults the workflow builders fill in for the settings left out of
+# the pipeline configuration
+SETTING_DEFAULTS = {"ghost_direction": "y", "use_bet": False,
+                    "fwhm_method": "native", "calculate_qi2": False,
+                    "outlier_method": "native", "quality_method": "native"}
+
+# the templates they default to, from the FSL standard images
+TEMPLATE_DEFAULTS = {"template_brain_for_anat": "MNI152_T1_2mm_brain.nii.gz",
+                     "template_skull_for_anat": "MNI152_T1_2mm.nii.gz"}
+
+
+def resolve_defaults(config):
+    """
+    Copy of a pipeline configuration with the defaults filled in, so that
+    a setting left out and the same setting given as its default make the
+    same keys.
+    """
+
+    settings = dict(SETTING_DEFAULTS)
+
+    for name, image in TEMPLATE_DEFAULTS.items():
+        if name not in config:
+            try:
+                from nipype.interfaces.fsl.base import Info
+                settings[name] = Info.standard_image(image)
+            except Exception:
+                # without FSL the builders cannot fill it in either
+                pass
+
+    settings.update(config)
+
+    return settings
+
+
+
+def file_digest(path, block_size=1024**2):
+    """
+    SHA-1 digest of the contents of a file, read `block_size` bytes at a
+    time.
+    """
+
+    import hashlib
+
+    sha = hashlib.sha1()
+
+    with open(path, "rb") as f:
+        block = f.read(block_size)
+        while block:
+            sha.update(block)
+            block = f.read(block_size)
+
+    return sha.hexdigest()
+
+
+def load_manifest(output_dir):
+    """
+    Read the cache manifest of a subject's output directory.
+
+    Returns (dict)
+    -------
+    manifest: dict
+        'inputs' maps the input file paths to their [mtime, size, digest],
+        'stages' maps the resources in the output directory to their keys
+    """
+
+    import json
+
+    manifest_file = op.join(output_dir, MANIFEST_NAME)
+
+    try:
+        with open(manifest_file, "r") as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        manifest = {}
+
+    manifest.setdefault("inputs", {})
+    manifest.setdefault("stages", {})
+
+    return manifest
+
+
+def save_manifest(output_dir, manifest):
+    """
+    Write the cache manifest of a subject's output directory, replacing
+    the previous one in a single rename.
+    """
+
+    import json
+
+    manifest_file = op.join(output_dir, MANIFEST_NAME)
+    tmp_file = manifest_file + ".tmp"
+
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+    os.rename(tmp_file, manifest_file)
+
+
+def input_digests(resource_pool, manifest):
+    """
+    Digest every input file of a subject.
+
+    Files are only read again when their modification time or size changed
+    since the digest recorded in the manifest, which is updated in place.
+
+    Returns (dict)
+    -------
+    digests: dict
+        the digest of each input, keyed by resource name
+    """
+
+    digests = {}
+
+    for resource, path in resource_pool.items():
+        if len(resource_pool[resource]) == 2 or not op.isfile(path):
+            continue
+
+        path = op.abspath(path)
+        st = os.stat(path)
+        known = manifest["inputs"].get(path)
+
+        if known and known[0] == st.st_mtime and known[1] == st.st_size:
+            digest = known[2]
+        else:
+            digest = file_digest(path)
+            manifest["inputs"][path] = [st.st_mtime, st.st_size, digest]
+
+        digests[resource] = digest
+
+    return digests
+
+
+def stage_key(resource, digests, config):
+    """
+    Key of a resource: the digests of the subject's inputs, the settings
+    the resource depends on and the QAP version.
+    """
+
+    import hashlib
+    import json
+
+    from qap.version import __version__
+
+    if resource in STAGE_SETTINGS:
+        names = STAGE_SETTINGS[resource]
+    else:
+        names = [name for name in config.keys() if name not in RUN_SETTINGS]
+
+    settings = dict((name, config.get(name)) for name in names)
+
+    content = json.dumps([resource, __version__, sorted(digests.items()),
+                          sorted(settings.items())], default=str)
+
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def reuse_outputs(output_dir, manifest, digests, settings, exclude=()):
+    """
+    Find the resources in a subject's output directory that can be reused:
+    those whose key in the manifest still matches and whose directory
+    holds their file. The others are removed from the directory and the
+    manifest.
+
+    Returns (tuple)
+    -------
+    reused: dict
+        the path of each reusable resource, keyed by resource name
+    removed: list
+        the names of the resources removed
+    """
+
+    import glob
+    import shutil
+
+    reused = {}
+    removed = []
+
+    for resource in os.listdir(output_dir):
+        if not op.isdir(op.join(output_dir, resource)) or \
+                resource in exclude:
+            continue
+
+        # (an empty directory, e.g. after an interrupted write, is a miss)
+        files = glob.glob(op.join(output_dir, resource, "*"))
+
+        if files and manifest["stages"].get(resource) == \
+                stage_key(resource, digests, settings):
+            reused[resource] = files[0]
+        else:
+            shutil.rmtree(op.join(output_dir, resource))
+            manifest["stages"].pop(resource, None)
+            removed.append(resource)
+
+    return reused, removed
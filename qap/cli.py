@@ -5,11 +5,14 @@
 
 import os
 import os.path as op
+import copy
 import time
 import argparse
+import logging
 import yaml
 
-from nipype import logging
+# nipype sets this logger up once it is imported, which is put off until
+# the thread budget is in place (see QAProtocolCLI.__init__)
 logger = logging.getLogger('workflow')
 
 
@@ -45,6 +48,12 @@ class QAProtocolCLI:
             "--with-reports", action='store_true', default=False,
             help="Write a summary report in PDF format.")
 
+        # Pick up an interrupted run
+        group.add_argument(
+            "--resume", action='store_true', default=False,
+            help="Skip the scans the run journal records as done, and run "
+                 "the failed and interrupted ones again.")
+
         args = parser.parse_args()
 
         # checks
@@ -112,8 +121,21 @@ class QAProtocolCLI:
         if args.with_reports:
             self._config['write_report'] = True
 
+        self._resume = args.resume
+
+        # numpy sizes the BLAS pools of the measures calculated in this
+        # process, and in the workers forked from it, from the environment
+        # when it is loaded, so the thread budget goes in before nipype
+        # (which loads it) is imported
+        _set_env(_thread_env(self._config))
+        import nipype
+
+        # individual reports written while the run goes on
+        self._report_pool = None
+        self._reports = {}
+
     def _run_here(self, run_name):
-        ns_at_once = self._config.get('num_subjects_at_once', 1)
+        ns_at_once = _core_budget(self._config)[0]
         with open(self._sub_dict, "r") as f:
             subdict = yaml.load(f)
 
@@ -162,28 +184,167 @@ class QAProtocolCLI:
         logger.info('There are %d subjects in the pool' %
                     len(flat_sub_dict.keys()))
 
-        # Stack workflow args
-        wfargs = [(flat_sub_dict[sub_info], self._config, sub_info,
-                  run_name, sites_dict.get(sub_info[0], None))
+        # Stack workflow args (every scan gets its own copy of the config,
+        # the workflow builders fill in defaults in it)
+        wfargs = [(flat_sub_dict[sub_info], copy.deepcopy(self._config),
+                   sub_info, run_name, sites_dict.get(sub_info[0], None))
                   for sub_info in flat_sub_dict.keys()]
 
+        # every scan started and finished is recorded in the run journal;
+        # when resuming, the scans it records as done are skipped
+        self._journal = op.join(
+            self._config['output_directory'], run_name,
+            'qap_%s_journal.jsonl' % self._config['qap_type'])
+
+        if not op.isdir(op.dirname(self._journal)):
+            os.makedirs(op.dirname(self._journal))
+
+        if self._resume:
+            journal = _read_journal(self._journal)
+            n_scans = len(wfargs)
+            wfargs = _pending_scans(wfargs, journal)
+            before = [journal.get(_scan_key(a[2])) for a in wfargs]
+
+            logger.info(
+                'Resuming: %d scans already done, %d to run (%d failed and '
+                '%d interrupted before)' % (
+                    n_scans - len(wfargs), len(wfargs),
+                    before.count('failed'), before.count('started')))
+
+        _journal_append(self._journal, {'event': 'run', 'scans': len(wfargs),
+                                        'resume': self._resume})
+
+        self._scans_total = len(wfargs)
+        self._scans_finished = 0
+        self._start_time = time.time()
+
+        # scans left for every subject, to know when one is complete
+        self._scans_left = {}
+        for a in wfargs:
+            sub_id = str(a[2][0])
+            self._scans_left[sub_id] = self._scans_left.get(sub_id, 0) + 1
+
         results = []
 
         # skip parallel machinery if we are running only one subject at once
         if ns_at_once == 1:
             for a in wfargs:
-                results.append(_run_workflow(a))
+                self._scan_started(a[2])
+                try:
+                    results.append(_run_workflow(a))
+                except Exception as e:
+                    results.append(_failed_result(a, e))
+                self._scan_done(results[-1], results, run_name)
         else:
-            from multiprocessing import Pool
+            results = self._run_scheduled(wfargs, ns_at_once, run_name)
+        return results
 
-            try:
-                pool = Pool(processes=ns_at_once, masktasksperchild=50)
-            except TypeError:  # Make python <2.7 compatible
-                pool = Pool(processes=ns_at_once)
+    def _scan_started(self, sub_info):
+        """
+        Record a scan as in flight in the run journal.
+        """
+        sub_id, session_id, scan_id = _scan_key(sub_info)
+        _journal_append(self._journal, {
+            'event': 'scan', 'subject': sub_id, 'session': session_id,
+            'scan': scan_id, 'status': 'started'})
+
+    def _scan_done(self, rt, results, run_name):
+        """
+        Handle a finished scan as soon as its worker returns: record it in
+        the run journal, log it with the throughput so far and, once all
+        the scans of its subject are done, queue the parts of the
+        subject's report that do not depend on the other subjects in the
+        background.
+        """
+        record = {'event': 'scan', 'subject': rt['id'],
+                  'session': rt['session'], 'scan': rt['scan'],
+                  'status': rt['status']}
+        if 'msg' in rt:
+            record['msg'] = str(rt['msg'])
+        _journal_append(self._journal, record)
+
+        self._scans_finished += 1
+        hours = (time.time() - self._start_time) / 3600.0
+        rate = self._scans_finished / max(hours, 1e-6)
+
+        logger.info('Subject %s (%s, %s): %s - %d/%d scans, %.1f scans per '
+                    'hour, about %.0f minutes left' % (
+                        rt['id'], rt['session'], rt['scan'], rt['status'],
+                        self._scans_finished, self._scans_total, rate,
+                        60 * (self._scans_total - self._scans_finished) /
+                        rate))
+
+        self._scans_left[rt['id']] -= 1
+        if self._report_pool is None or self._scans_left[rt['id']]:
+            return
+
+        from qap.viz.reports import subject_report
+
+        qap_type = 'qap_' + self._config['qap_type']
+        sub_results = [r for r in results if r['id'] == rt['id']]
+
+        self._reports[rt['id']] = self._report_pool.apply_async(
+            subject_report, (qap_type, run_name, rt['id'], sub_results),
+            {'out_dir': self._config['output_directory']})
+
+    def _run_scheduled(self, wfargs, ns_at_once, run_name):
+        """
+        Run the subjects in a pool of ns_at_once workers, largest first.
+
+        The peak memory of every subject is estimated from the headers of
+        its images; with a memory_budget_gb setting, a subject is only
+        started once its estimate fits next to the subjects already
+        running (a subject larger than the whole budget runs on its own).
+        Workers are replaced after every subject, so the memory of one
+        subject is given back before the next starts.
+        """
+        from multiprocessing import Pool
+
+        budget = self._config.get('memory_budget_gb', None)
+        if budget:
+            budget = float(budget) * 1024**3
+
+        pending = [(_estimate_peak_memory(a[0], self._config['qap_type']), a)
+                   for a in wfargs]
 
-            results = pool.map(_run_workflow, wfargs)
-            pool.close()
+        try:
+            pool = Pool(processes=ns_at_once, maxtasksperchild=1)
+        except TypeError:  # Make python <2.7 compatible
+            pool = Pool(processes=ns_at_once)
+
+        running = []
+        results = []
+
+        try:
+            while pending or running:
+                for job in _admit(pending, [job[0] for job in running],
+                                  ns_at_once, budget):
+                    if budget and job[0] > budget:
+                        logger.warning(
+                            'Subject %s is estimated to need %.1f GB, more '
+                            'than memory_budget_gb, and runs on its own' %
+                            (job[1][2][0], job[0] / 1024.0**3))
+
+                    pending.remove(job)
+                    self._scan_started(job[1][2])
+                    running.append(
+                        (job[0], pool.apply_async(_run_workflow, (job[1],)),
+                         job[1]))
+
+                time.sleep(0.5)
+
+                for job in [job for job in running if job[1].ready()]:
+                    running.remove(job)
+                    results.append(_job_result(job[1], job[2]))
+                    self._scan_done(results[-1], results, run_name)
+        except:
             pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
         return results
 
     def _run_cloud(self, run_name):
@@ -209,7 +370,7 @@ class QAProtocolCLI:
         config = self._config
         subject_list = self._sub_dict
         cloudify = self._cloudify
-        ns_at_once = config.get('num_subjects_at_once', 1)
+        ns_at_once = _core_budget(config)[0]
         write_report = config.get('write_report', False)
 
         # Create output directory
@@ -236,6 +397,13 @@ class QAProtocolCLI:
 
         run_name = config['pipeline_config_yaml'].split("/")[-1].split(".")[0]
 
+        # the parts of the individual reports that only depend on their
+        # subject are written in the background, each as soon as its
+        # subject is done
+        if write_report and not cloudify:
+            from multiprocessing import Pool
+            self._report_pool = Pool(processes=1)
+
         results = None
         if not cloudify:
             results = self._run_here(run_name)
@@ -249,15 +417,265 @@ class QAProtocolCLI:
             qap_type = 'qap_' + config['qap_type']
             in_csv = op.join(config['output_directory'], '%s.csv' % qap_type)
 
-            reports = workflow_report(in_csv, qap_type, run_name, results,
-                                      out_dir=config['output_directory'])
+            # (the parts that failed are written again below)
+            parts = {}
+            for sub_id, job in self._reports.items():
+                try:
+                    parts[sub_id] = job.get()['parts']
+                except Exception as e:
+                    logger.warn('Report of subject %s failed: %s' %
+                                (sub_id, e))
+
+            if self._report_pool is not None:
+                self._report_pool.close()
+                self._report_pool.join()
+
+            # the group report and the individual reports, which compare
+            # every subject to the whole group once all the measures are in
+            reports = workflow_report(
+                in_csv, qap_type, run_name, results,
+                out_dir=config['output_directory'], subject_parts=parts)
 
             for k, v in reports.iteritems():
                 if v['success']:
                     logger.info('Written report (%s) in %s' % (k, v['path']))
 
 
+# thread pool sizes of BLAS (OpenBLAS, MKL, Accelerate), OpenMP (AFNI) and
+# ITK (ANTs)
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                   'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                   'NUMEXPR_NUM_THREADS',
+                   'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS']
+
+
+def _scan_key(sub_info):
+    """
+    (subject, session, scan) of a subject list entry, named as in the
+    output directory and the measures.
+    """
+    return (str(sub_info[0]), sub_info[1] or "session_0",
+            sub_info[2] or "scan_0")
+
+
+def _journal_append(journal_file, record):
+    """
+    Append one record to the run journal (one JSON object per line) and
+    flush it to disk before returning, so the journal survives a crash of
+    the driver at any point.
+    """
+    import json
+
+    record['time'] = time.strftime("%Y-%m-%d %H:%M:%S")
+    line = (json.dumps(record) + '\n').encode('utf-8')
+
+    with open(journal_file, 'ab+') as f:
+        # start on a new line after a record cut short by a crash
+        f.seek(0, 2)
+        if f.tell() > 0:
+            f.seek(-1, 2)
+            if f.read(1) != b'\n':
+                line = b'\n' + line
+
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _read_journal(journal_file):
+    """
+    Last recorded status ('started', 'finished', 'failed' or 'cached') of
+    every scan in the run journal, keyed by (subject, session, scan). A
+    line cut short by a crash is ignored.
+    """
+    import json
+
+    status = {}
+    if not op.isfile(journal_file):
+        return status
+
+    with open(journal_file, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+
+            if record.get('event') == 'scan':
+                status[(record['subject'], record['session'],
+                        record['scan'])] = record['status']
+
+    return status
+
+
+def _pending_scans(wfargs, journal):
+    """
+    The workflow args of the scans still to run when resuming: the ones
+    the journal does not record as 'finished' or 'cached'.
+    """
+    return [a for a in wfargs
+            if journal.get(_scan_key(a[2])) not in ('finished', 'cached')]
+
+
+def _core_budget(config):
+    """
+    Split the num_cores_total setting between the subjects running at
+    once, the nipype nodes running at once for each subject and the
+    threads of each node.
+
+    num_subjects_at_once and num_cores_per_subject are lowered until they
+    fit the budget, and the cores of a subject that are not used by
+    parallel nodes go to the threads of each node. Without a budget the
+    two settings are used as given and the thread pools are left alone.
+
+    Returns (tuple)
+    -------
+    (subjects at once, cores per subject, threads per node or None)
+    """
+    ns_at_once = config.get('num_subjects_at_once', 1)
+    nc_per_subject = config.get('num_cores_per_subject', 1)
+    total = config.get('num_cores_total', None)
+
+    if not total:
+        return ns_at_once, nc_per_subject, None
+
+    ns_at_once = max(1, min(ns_at_once, total))
+    subject_share = max(1, total // ns_at_once)
+    nc_per_subject = max(1, min(nc_per_subject, subject_share))
+
+    return ns_at_once, nc_per_subject, \
+        max(1, subject_share // nc_per_subject)
+
+
+def _thread_env(config):
+    """
+    Environment variables sizing the thread pools of every node to the
+    core budget (none without a budget).
+    """
+    threads_per_node = _core_budget(config)[2]
+    if not threads_per_node:
+        return {}
+
+    return dict((env_var, str(threads_per_node))
+                for env_var in THREAD_ENV_VARS)
+
+
+def _set_env(env):
+    """
+    Set environment variables (unsetting those whose value is None) and
+    return their previous values, to put them back with _set_env again.
+    """
+    saved = dict((name, os.environ.get(name)) for name in env)
+
+    for name, value in env.items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+
+    return saved
+
+
+def _admit(pending, running, ns_at_once, budget=None):
+    """
+    Pick the pending subjects to start next, largest first.
+
+    pending holds (estimated peak memory, workflow args) pairs and running
+    the estimates of the subjects already running. Subjects are admitted
+    while there is a free worker and their estimate fits in what is left
+    of the budget (in bytes); a subject larger than the whole budget is
+    only admitted when nothing else runs.
+    """
+    admitted = []
+    in_use = sum(running)
+
+    for job in sorted(pending, key=lambda job: job[0], reverse=True):
+        if len(running) + len(admitted) >= ns_at_once:
+            break
+
+        if budget and (running or admitted) and in_use + job[0] > budget:
+            continue
+
+        admitted.append(job)
+        in_use += job[0]
+
+    return admitted
+
+
+def _job_result(async_result, args):
+    """
+    Result of a subject run in the pool; a subject whose run raised
+    (e.g. before its workflow started) is reported as failed.
+    """
+    try:
+        return async_result.get()
+    except Exception as e:
+        return _failed_result(args, e)
+
+
+def _failed_result(args, error):
+    """
+    Result of a subject whose run raised the exception error.
+    """
+    sub_id, session_id, scan_id = _scan_key(args[2])
+    return {'id': sub_id, 'session': session_id, 'scan': scan_id,
+            'status': 'failed', 'msg': error}
+
+
+def _estimate_peak_memory(resource_pool, qap_type):
+    """
+    Rough peak memory of one subject, in bytes, from the headers of its
+    images only.
+
+    The measures work on float64 copies of an image, and the functional
+    temporal ones hold the time series, its derivative and their
+    standardized versions at once, so the largest image counts twice
+    (three times for the temporal measures) at 8 bytes per voxel.
+    """
+    import numpy as np
+    import nibabel as nb
+
+    largest = 0
+    for resource, path in resource_pool.items():
+        if len(resource_pool[resource]) == 2 or '.nii' not in path:
+            continue
+
+        try:
+            shape = nb.load(path).get_header().get_data_shape()
+        except Exception:  # unreadable here (e.g. not downloaded yet)
+            continue
+
+        largest = max(largest, int(np.prod(shape)) * 8)
+
+    if 'temporal' in qap_type:
+        return 3 * largest
+
+    return 2 * largest
+
+
 def _run_workflow(args):
+    """
+    Run the pipeline of one subject with the thread pools of the tools its
+    nodes call (and of the Python processes they start) sized by the core
+    budget, and with the image cache of the loaders in qap_utils. Both run
+    inside nipype nodes, so they are configured through the environment,
+    which is put back afterwards: when subjects run one at a time this is
+    the driver process, and the settings must not carry over to the next
+    subjects or the report workers.
+    """
+    env = _thread_env(args[1])
+    if args[1].get('image_cache_mb', 0):
+        env['QAP_IMAGE_CACHE_MB'] = str(args[1]['image_cache_mb'])
+
+    saved = _set_env(env)
+
+    try:
+        return _run_scan(args)
+    finally:
+        _set_env(saved)
+
+
+def _run_scan(args):
 
     # build pipeline for each subject, individually
     # ~ 5 min 20 sec per subject
@@ -278,6 +696,7 @@ def _run_workflow(args):
     import time
     from time import strftime
     from nipype import config as nyconfig
+    from nipype import logging as nylogging
 
     resource_pool, config, subject_info, run_name, site_name = args
     sub_id = str(subject_info[0])
@@ -296,6 +715,7 @@ def _run_workflow(args):
 
     # Read and apply general settings in config
     keep_outputs = config.get('write_all_outputs', False)
+
     output_dir = op.join(config["output_directory"], run_name,
                          sub_id, session_id, scan_id)
 
@@ -314,7 +734,7 @@ def _run_workflow(args):
     # set up logging
     nyconfig.update_config(
         {'logging': {'log_directory': log_dir, 'log_to_file': True}})
-    logging.update_logging(nyconfig)
+    nylogging.update_logging(nyconfig)
 
     # take date+time stamp for run identification purposes
     unique_pipeline_id = strftime("%Y%m%d%H%M%S")
@@ -341,12 +761,27 @@ def _run_workflow(args):
     workflow.config['execution'] = \
         {'crashdump_dir': config["output_directory"]}
 
-    # update that resource pool with what's already in the output directory
-    for resource in os.listdir(output_dir):
-        if (op.isdir(op.join(output_dir, resource)) and
-                resource not in resource_pool.keys()):
-            resource_pool[resource] = glob.glob(op.join(output_dir,
-                                                        resource, "*"))[0]
+    # key the resources in the output directory by the digests of the
+    # inputs, the settings they depend on and the QAP version
+    from qap.cache_utils import load_manifest, save_manifest, \
+        input_digests, stage_key, resolve_defaults, reuse_outputs
+
+    # (with the defaults resolved, so that leaving a setting out and giving
+    # its default make the same keys)
+    manifest = load_manifest(output_dir)
+    digests = input_digests(resource_pool, manifest)
+    settings = resolve_defaults(config)
+
+    # update that resource pool with what's already in the output
+    # directory, as long as it was computed from the same inputs and
+    # settings; anything else is removed and computed again
+    reused, removed = reuse_outputs(output_dir, manifest, digests, settings,
+                                    exclude=resource_pool.keys())
+    resource_pool.update(reused)
+
+    for resource in removed:
+        logger.info("Recomputing %s, its inputs or settings have changed"
+                    % resource)
 
     # resource pool check
     invalid_paths = []
@@ -411,15 +846,20 @@ def _run_workflow(args):
                 dotfilename=op.join(output_dir, run_name + ".dot"),
                 simple_form=False)
 
-        nc_per_subject = config.get('num_cores_per_subject', 1)
+        nc_per_subject = _core_budget(config)[1]
         runargs = {'plugin': 'Linear', 'plugin_args': {}}
         if nc_per_subject > 1:
-            runargs['plugin'] = 'MultiProc',
+            runargs['plugin'] = 'MultiProc'
             runargs['plugin_args'] = {'n_procs': nc_per_subject}
 
         try:
             workflow.run(**runargs)
             rt['status'] = 'finished'
+
+            for output in out_list:
+                if len(resource_pool[output]) == 2:
+                    manifest["stages"][output] = \
+                        stage_key(output, digests, settings)
         except Exception as e:  # TODO We should be more specific here ...
             rt.update({'status': 'failed', 'msg': e})
             # ... however this is run inside a pool.map: do not raise Execption
@@ -428,6 +868,8 @@ def _run_workflow(args):
         rt['status'] = 'cached'
         logger.info("\nEverything is already done for subject %s." % sub_id)
 
+    save_manifest(output_dir, manifest)
+
     # Remove working directory when done
     if not keep_outputs:
         try:
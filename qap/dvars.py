@@ -3,40 +3,46 @@ import numpy as np
 from scipy import stats
 
 
-def remove_zero_variance_voxels(func_timeseries, mask):
-
-    for i in range(0, len(func_timeseries)):
-
-        for j in range(0, len(func_timeseries[0])):
+def remove_zero_variance_voxels(func_timeseries, mask, chunk_size=10000):
+    """
+    Zero out the mask at voxels whose time series has (near-)zero variance.
 
-            for k in range(0, len(func_timeseries[0][0])):
+    The variance is only computed for voxels inside the mask, in chunks of
+    `chunk_size` voxels, so the 4D array is never copied as a whole. As
+    before, a voxel is dropped when its variance truncates to zero.
+    """
+    vox_idx = np.nonzero(mask)
 
-                var = func_timeseries[i][j][k].var()
+    for start in range(0, len(vox_idx[0]), chunk_size):
 
-                if int(var) == 0:
+        chunk_idx = tuple(idx[start:start + chunk_size] for idx in vox_idx)
+        chunk_ts = func_timeseries[chunk_idx].astype(np.float64)
+        chunk_var = chunk_ts.reshape(len(chunk_ts), -1).var(1)
 
-                    mask[i][j][k] = mask[i][j][k] * 0
+        zero_var = chunk_var < 1
+        if zero_var.any():
+            mask[tuple(idx[zero_var] for idx in chunk_idx)] = 0
 
     return mask
 
 
 
-def load(func_file, mask_file, check4d=True):
+def load(func_file, mask_file, check4d=True, chunk_size=10000):
 
     func_img    = nib.load(func_file)
     mask_img    = nib.load(mask_file)
 
     mask        = mask_img.get_data()
-    func        = func_img.get_data().astype(np.float)
+    func        = func_img.get_data()
 
     if check4d and len(func.shape) != 4:
         raise Exception("Input functional %s should be 4-dimensional" % func_file)
 
-    mask_var_filtered = remove_zero_variance_voxels(func, mask)
+    mask_var_filtered = remove_zero_variance_voxels(func, mask, chunk_size)
+
+    # only the masked voxels are cast, giving ntpts x nvoxs
+    func        = func[mask_var_filtered.nonzero()].astype(np.float64).T
 
-    func        = func[mask_var_filtered.nonzero()].T # will have ntpts x nvoxs
-    
-    
     return func
 
 
@@ -83,7 +89,36 @@ def ar_statsmodels(x, order=(1,0), trend='nc'):
 
 
 
-def ar1(func, method=ar_nitime):
+def ar_batched(func, chunk_size=10000):
+    """
+    Lag-1 autoregressive coefficient of every voxel at once.
+
+    For order 1 the Yule-Walker estimate used by `ar_nitime` reduces to the
+    lag-1 autocovariance divided by the variance, so it is computed directly
+    on blocks of `chunk_size` voxels of the ntpts x nvoxs matrix, instead of
+    running an FFT and a Toeplitz solve per voxel.
+    """
+    ar_vals = np.empty(func.shape[1])
+
+    for start in range(0, func.shape[1], chunk_size):
+
+        chunk = func[:, start:start + chunk_size]
+        chunk = chunk - chunk.mean(0)
+
+        lag1 = (chunk[1:] * chunk[:-1]).sum(0)
+        lag0 = (chunk ** 2).sum(0)
+
+        ar_vals[start:start + chunk_size] = lag1 / lag0
+
+    return ar_vals
+
+
+
+def ar1(func, method=ar_batched):
+    # the batched estimator works on the whole matrix, the reference
+    # backends (ar_nitime, ar_statsmodels) on one voxel time series at a time
+    if method is ar_batched:
+        return ar_batched(func)
     func_centered = func - func.mean(0)
     #import code
     #code.interact(local=locals())
@@ -92,12 +127,20 @@ def ar1(func, method=ar_nitime):
 
 
 
-def calc_dvars(func, output_all=False, interp="fraction"):
+def calc_dvars(func, output_all=False, interp="fraction", method=ar_batched,
+               block_size=None):
+    # with a block size, work through blocks of voxels instead of holding
+    # the derivative and its standardized copy for the whole matrix
+    if block_size:
+        blocks = (func[:, start:start + block_size]
+                  for start in range(0, func.shape[1], block_size))
+        return calc_dvars_blocks(blocks, output_all, interp, method)
+
     # Robust standard deviation
     func_sd     = robust_stdev(func, interp)
     
     # AR1
-    func_ar1    = ar1(func)
+    func_ar1    = ar1(func, method)
 
     # Predicted standard deviation of temporal derivative
     func_sd_pd  = np.sqrt(2 * (1 - func_ar1)) * func_sd
@@ -124,15 +167,189 @@ def calc_dvars(func, output_all=False, interp="fraction"):
 
 
 
+def _merge_moments(moments, n_a, x):
+    """
+    Update the per-frame (row) count-weighted mean and sum of squared
+    deviations of the first n_a columns with the columns of x (the
+    pairwise update of Chan et al.), so the standard deviation across all
+    voxels can be accumulated block by block.
+    """
+    n_b         = x.shape[1]
+    mean_b      = x.mean(1)
+    m2_b        = ((x - mean_b[:, np.newaxis])**2).sum(1)
+
+    if moments is None:
+        return mean_b, m2_b
+
+    mean_a, m2_a = moments
+    n           = n_a + n_b
+    delta       = mean_b - mean_a
+
+    mean        = mean_a + delta * n_b / n
+    m2          = m2_a + m2_b + delta**2 * n_a * n_b / n
+
+    return mean, m2
+
+
+def calc_dvars_blocks(blocks, output_all=False, interp="fraction",
+                      method=ar_batched):
+    """
+    Streaming version of `calc_dvars`.
+
+    `blocks` is an iterable of ntpts x nvoxs blocks of voxels (columns of
+    the matrix `calc_dvars` takes, e.g. from `iter_masked_blocks`). The
+    robust standard deviation, AR1 and temporal derivative are computed
+    for one block at a time; only the per-frame moments of the raw and
+    voxelwise standardized derivatives and the sum of the predicted
+    derivative standard deviations are kept between blocks.
+    """
+
+    nvoxs       = 0
+    sd_pd_sum   = 0.
+    plain       = None
+    vx_stdz     = None
+
+    for block in blocks:
+
+        if block.shape[1] == 0:
+            continue
+
+        # Predicted standard deviation of temporal derivative
+        func_sd_pd  = np.sqrt(2 * (1 - ar1(block, method))) * \
+                      robust_stdev(block, interp)
+
+        # Compute temporal difference time series
+        func_deriv  = np.diff(block, axis=0)
+        plain       = _merge_moments(plain, nvoxs, func_deriv)
+
+        ## voxelwise standardization, in place
+        func_deriv /= func_sd_pd
+        vx_stdz     = _merge_moments(vx_stdz, nvoxs, func_deriv)
+
+        sd_pd_sum  += func_sd_pd.sum()
+        nvoxs      += block.shape[1]
+
+    if nvoxs < 2:
+        raise Exception("DVARS needs at least two voxels with signal")
+
+    diff_sd_mean = sd_pd_sum / nvoxs
+
+    # DVARS
+    dvars_plain = np.sqrt(plain[1] / (nvoxs - 1))
+    dvars_stdz  = dvars_plain/diff_sd_mean
+    dvars_vx_stdz = np.sqrt(vx_stdz[1] / (nvoxs - 1))
+
+    if output_all:
+        out = np.vstack((dvars_stdz, dvars_plain, dvars_vx_stdz))
+    else:
+        out = dvars_stdz.reshape(len(dvars_stdz), 1)
+
+    return out
+
+
+def uncompressed_image(func_file, tmp_dir):
+    """
+    Path to an uncompressed copy of `func_file` that can be memory-mapped:
+    the file itself, or a .nii decompressed into `tmp_dir` when it is
+    gzipped.
+    """
+
+    import gzip
+    import os
+    import shutil
+
+    if not func_file.endswith(".gz"):
+        return func_file
+
+    nii_file = os.path.join(tmp_dir, "func.nii")
+    with gzip.open(func_file, "rb") as f_in:
+        with open(nii_file, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+
+    return nii_file
+
+
+def masked_slabs(mask, block_size=10000):
+    """
+    Group consecutive axial slices of a mask into (z0, z1) slabs of about
+    `block_size` masked voxels each.
+    """
+
+    slice_counts = mask.sum((0, 1))
+    slabs   = []
+    start   = 0
+    total   = 0
+    for z in range(mask.shape[2]):
+        total += slice_counts[z]
+        if total >= block_size:
+            slabs.append((start, z + 1))
+            start, total = z + 1, 0
+    if total > 0:
+        slabs.append((start, mask.shape[2]))
+
+    return slabs
+
+
+def iter_masked_blocks(func_file, mask_file, block_size=10000,
+                       drop_constant=True):
+    """
+    Yield the masked functional time series as float64 ntpts x nvoxs
+    blocks of at most `block_size` voxels, dropping zero-variance voxels as
+    `load` does (unless `drop_constant` is False).
+
+    The 4D image is memory-mapped (a compressed file is first decompressed
+    to a temporary .nii), and read one slab of axial slices at a time, so
+    the whole time series is never in memory. The voxels come slab by slab
+    (see `masked_slabs`), in the order of `mask[:, :, z0:z1]` within each.
+    """
+
+    import shutil
+    from tempfile import mkdtemp
+
+    tmp_dir = mkdtemp()
+
+    try:
+        func_img = nib.load(uncompressed_image(func_file, tmp_dir),
+                            mmap=True)
+
+        if len(func_img.shape) != 4:
+            raise Exception("Input functional %s should be 4-dimensional" \
+                            % func_file)
+
+        mask    = nib.load(mask_file).get_data() != 0
+
+        for z0, z1 in masked_slabs(mask, block_size):
+
+            slab    = np.asanyarray(func_img.dataobj[:, :, z0:z1, :])
+            slab    = slab[mask[:, :, z0:z1]].astype(np.float64).T
+            if drop_constant:
+                slab = slab[:, slab.var(0) >= 1]
+
+            for start in range(0, slab.shape[1], block_size):
+                yield slab[:, start:start + block_size]
+
+            del slab
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
 def calc_mean_dvars(dvars):
     mean_dvars = dvars.mean(0)
     return mean_dvars
 
 
 
-def mean_dvars_wrapper(func_file, mask_file, dvars_out_file=None):
-    func    = load(func_file, mask_file)
-    dvars   = calc_dvars(func)
+def mean_dvars_wrapper(func_file, mask_file, dvars_out_file=None,
+                       block_size=None):
+    # with a block size, stream the voxels from disk instead of loading
+    # the whole masked time series
+    if block_size:
+        blocks  = iter_masked_blocks(func_file, mask_file, block_size)
+        dvars   = calc_dvars_blocks(blocks)
+    else:
+        func    = load(func_file, mask_file)
+        dvars   = calc_dvars(func)
     if dvars_out_file:
         np.savetxt(dvars_out_file, dvars, fmt='%.12f')
     mean_d  = calc_mean_dvars(dvars)
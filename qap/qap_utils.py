@@ -1,51 +1,192 @@
-def load_image(image_file):
+import os
+from collections import OrderedDict
+
+
+# per-process cache of decompressed image data, see load_image_data
+_image_cache = OrderedDict()
+
+
+
+def image_cache_budget():
+
+    '''
+    outputs
+        budget: size of the image data cache in bytes, from the
+                QAP_IMAGE_CACHE_MB environment variable (set from the
+                image_cache_mb pipeline setting); 0 disables the cache
+    '''
+
+    try:
+        return int(float(os.environ.get("QAP_IMAGE_CACHE_MB", 0)) * 1024**2)
+    except ValueError:
+        return 0
+
+
+
+def load_image_data(image_file):
+
+    import nibabel as nib
+    import numpy as np
+
+    '''
+    inputs
+        image_file: path to an image
+
+    outputs
+        dat: the image data, as returned by Nibabel
+
+    When the cache is enabled, decompressed data is kept per process, keyed
+    by (path, modification time, size), and evicted least recently used
+    first once the byte budget is exceeded. Cached arrays are read-only, so
+    copy before modifying. Memory-mapped data is not cached, as re-opening
+    it costs nothing.
+    '''
+
+    budget = image_cache_budget()
+
+    if not budget:
+        return nib.load(image_file, mmap=True).get_data()
+
+    stat = os.stat(image_file)
+    key = (os.path.abspath(image_file), stat.st_mtime, stat.st_size)
+
+    if key in _image_cache:
+        # move to the most recently used end
+        dat = _image_cache.pop(key)
+        _image_cache[key] = dat
+        return dat
+
+    dat = nib.load(image_file, mmap=True).get_data()
+
+    if isinstance(dat, np.memmap) or dat.nbytes > budget:
+        return dat
+
+    dat.setflags(write=False)
+    _image_cache[key] = dat
+
+    cache_size = sum([cached.nbytes for cached in _image_cache.values()])
+
+    while cache_size > budget:
+        evicted_key, evicted = _image_cache.popitem(last=False)
+        cache_size -= evicted.nbytes
+
+    return dat
+
+
+
+def clear_image_cache():
+
+    '''
+    Empty the image data cache of this process.
+    '''
+
+    _image_cache.clear()
+
+
+
+def load_image(image_file, return_clipped=False):
 
     import nibabel as nib
     import numpy as np
 
+    from qap.qap_utils import load_image_data
+    from qap.spatial_qc import clip_negatives
+
     '''
     inputs
         image_file: path to an image, usually a structural or functional scan
+        return_clipped: also return the number of negative voxels
 
     outputs
         dat: the image data in Nibabel format
+        n_clipped: (if return_clipped) the number of negative voxels; they
+                   are set to zero in floating point images
+
+    Uncompressed images are memory-mapped (copy-on-write), other images go
+    through the image data cache, and the data is only copied when it has
+    to be cast or have negative values zeroed.
     '''
 
-    img = nib.load(image_file)
-    dat = img.get_data()
+    dat = load_image_data(image_file)
 
     # Ensure that data is cast as at least 32-bit
     if np.issubdtype(dat.dtype, float):
 
-        dat = dat.astype('float32')
+        if dat.dtype != np.float32:
+            dat = dat.astype('float32')
 
-        # Check for negative values
-        if (dat < 0).any():
-            print "found negative values, setting to zero (see file: %s)" % image_file
-            dat[dat<0] = 0
+        # Zero out negative values
+        dat, n_clipped = clip_negatives(dat, in_place=True)
 
     elif np.issubdtype(dat.dtype, int):
 
-        dat = dat.astype('int32')
+        if dat.dtype != np.int32:
+            dat = dat.astype('int32')
+
+        n_clipped = int(np.count_nonzero(dat < 0))
 
     elif np.issubdtype(dat.dtype, np.uint8):
 
-        dat = dat.astype(np.uint8)
+        n_clipped = 0
 
     else:
 
         msg = "Error: Unknown datatype %s" % dat.dtype
         raise Exception(msg)
 
+    if return_clipped:
+        return dat, n_clipped
+
     return dat
 
 
 
+def is_binary_mask(mask_dat, chunk_size=16):
+
+    import numpy as np
+
+    '''
+    inputs
+        mask_dat: mask image data (may be memory-mapped)
+        chunk_size: number of slices along the last axis checked at a time
+
+    outputs
+        binary: True if the data holds exactly the values 0 and 1
+
+    The data is checked slab by slab (min, max and, for floating point
+    data, non-integer values) instead of sorting it with np.unique.
+    '''
+
+    integral = mask_dat.dtype == bool or \
+        np.issubdtype(mask_dat.dtype, np.integer)
+
+    has_zero = False
+    has_one = False
+
+    for start in range(0, mask_dat.shape[-1], chunk_size):
+
+        chunk = mask_dat[..., start:start + chunk_size]
+
+        if chunk.min() < 0 or chunk.max() > 1:
+            return False
+
+        if not integral and ((chunk != 0) & (chunk != 1)).any():
+            return False
+
+        has_zero = has_zero or chunk.min() == 0
+        has_one = has_one or chunk.max() == 1
+
+    return has_zero and has_one
+
+
+
 def load_mask(mask_file, ref_file):
 
     import nibabel as nib
     import numpy as np
 
+    from qap.qap_utils import is_binary_mask, load_image_data
+
     '''
     inputs
         mask_file: binarized mask file
@@ -55,17 +196,10 @@ def load_mask(mask_file, ref_file):
         mask_dat: the mask file in Nibabel format
     '''
 
-    mask_img = nib.load(mask_file)
-    mask_dat = mask_img.get_data()
+    # only the headers are read for the reference image
+    mask_img = nib.load(mask_file, mmap=True)
     ref_img = nib.load(ref_file)
 
-    # Check that the specified mask is binary.
-    mask_vals   = np.unique(mask_dat)
-    if (mask_vals.size != 2) or not (mask_vals == [0, 1]).all():
-        err = "Error: Mask is not binary, has %i unique val(s) of %s " \
-              "(see file %s)" % (mask_vals.size, mask_vals, mask_file)
-        raise Exception(err)
-
     # Verify that the mask and anatomical images have the same dimensions.
     if ref_img.shape != mask_img.shape:
         err = "Error: Mask and anatomical image are different dimensions " \
@@ -73,9 +207,214 @@ def load_mask(mask_file, ref_file):
         raise Exception(err)
 
     # Verify that the mask and anatomical images are in the same space (have the samme affine matrix)
-    if (mask_img.get_affine() == ref_img.get_affine()).all == False:
+    if not np.allclose(mask_img.get_affine(), ref_img.get_affine()):
         err = "Error: Mask and anatomical image are not in the same space " \
               "for %s vs %s" % (mask_file, ref_file)
         raise Exception(err)
 
+    mask_dat = load_image_data(mask_file)
+
+    # Check that the specified mask is binary.
+    if not is_binary_mask(mask_dat):
+        mask_vals   = np.unique(mask_dat)
+        err = "Error: Mask is not binary, has %i unique val(s) of %s " \
+              "(see file %s)" % (mask_vals.size, mask_vals, mask_file)
+        raise Exception(err)
+
     return mask_dat
+
+
+
+def get_pixdim(image_file):
+
+    import nibabel as nib
+
+    '''
+    inputs
+        image_file: path to an image
+
+    outputs
+        pixdim: the voxel dimensions along x, y and z, read from the header
+                only (the image data is not loaded)
+    '''
+
+    hdr = nib.load(image_file).get_header()
+
+    return hdr['pixdim'][1:4]
+
+
+
+# Registry of the measures each QAP pipeline can calculate. Every entry
+# lists the CSV columns it fills, the resources it has to load, the
+# measures it is derived from and a rough cost: "low" for a pass over data
+# that is loaded anyway, "high" for morphology, smoothness estimation or an
+# AFNI subprocess. Measures left out by the 'measures' pipeline setting are
+# never calculated, and their columns are written out empty.
+QAP_MEASURES = {
+    "anatomical_spatial": OrderedDict([
+        ("summary", {"columns": ["fg_mean", "fg_std", "fg_size",
+                                 "bg_mean", "bg_std", "bg_size"],
+                     "inputs": ["anatomical_reorient", "qap_head_mask"],
+                     "requires": [], "cost": "low"}),
+        ("tissue", {"columns": ["gm_mean", "gm_std", "gm_size",
+                                "wm_mean", "wm_std", "wm_size",
+                                "csf_mean", "csf_std", "csf_size"],
+                    "inputs": ["anatomical_reorient", "qap_head_mask",
+                               "anatomical_gm_mask", "anatomical_wm_mask",
+                               "anatomical_csf_mask"],
+                    "requires": ["summary"], "cost": "low"}),
+        ("fber", {"columns": ["fber"],
+                  "inputs": ["anatomical_reorient", "qap_head_mask"],
+                  "requires": ["summary"], "cost": "low"}),
+        ("efc", {"columns": ["efc"], "inputs": ["anatomical_reorient"],
+                 "requires": [], "cost": "low"}),
+        ("qi1", {"columns": ["qi1", "qi2"],
+                 "inputs": ["anatomical_reorient", "qap_head_mask"],
+                 "requires": [], "cost": "high"}),
+        ("fwhm", {"columns": ["fwhm_x", "fwhm_y", "fwhm_z", "fwhm"],
+                  "inputs": ["anatomical_reorient", "qap_head_mask"],
+                  "requires": [], "cost": "high"}),
+        ("snr", {"columns": ["snr"],
+                 "inputs": ["anatomical_reorient", "qap_head_mask"],
+                 "requires": ["summary"], "cost": "low"}),
+        ("cnr", {"columns": ["cnr"],
+                 "inputs": ["anatomical_reorient", "qap_head_mask",
+                            "anatomical_gm_mask", "anatomical_wm_mask",
+                            "anatomical_csf_mask"],
+                 "requires": ["summary", "tissue"], "cost": "low"})
+    ]),
+    "functional_spatial": OrderedDict([
+        ("summary", {"columns": ["fg_mean", "fg_std", "fg_size",
+                                 "bg_mean", "bg_std", "bg_size"],
+                     "inputs": ["mean_functional", "functional_brain_mask"],
+                     "requires": [], "cost": "low"}),
+        ("fber", {"columns": ["fber"],
+                  "inputs": ["mean_functional", "functional_brain_mask"],
+                  "requires": [], "cost": "low"}),
+        ("efc", {"columns": ["efc"], "inputs": ["mean_functional"],
+                 "requires": [], "cost": "low"}),
+        ("fwhm", {"columns": ["fwhm_x", "fwhm_y", "fwhm_z", "fwhm"],
+                  "inputs": ["mean_functional", "functional_brain_mask"],
+                  "requires": [], "cost": "high"}),
+        ("ghost", {"columns": ["ghost_x", "ghost_y", "ghost_z"],
+                   "inputs": ["mean_functional", "functional_brain_mask"],
+                   "requires": [], "cost": "low"}),
+        ("snr", {"columns": ["snr"],
+                 "inputs": ["mean_functional", "functional_brain_mask"],
+                 "requires": ["summary"], "cost": "low"})
+    ]),
+    "functional_temporal": OrderedDict([
+        ("dvars", {"columns": ["dvars"],
+                   "inputs": ["func_motion_correct", "functional_brain_mask"],
+                   "requires": [], "cost": "low"}),
+        ("tsnr", {"columns": ["m_tsnr"],
+                  "inputs": ["func_motion_correct", "functional_brain_mask"],
+                  "requires": [], "cost": "low"}),
+        ("fd", {"columns": ["mean_fd", "num_fd", "perc_fd"],
+                "inputs": ["coordinate_transformation"],
+                "requires": [], "cost": "low"}),
+        ("outlier", {"columns": ["outlier"],
+                     "inputs": ["func_motion_correct",
+                                "functional_brain_mask"],
+                     "requires": [], "cost": "high"}),
+        ("quality", {"columns": ["quality"],
+                     "inputs": ["func_motion_correct",
+                                "functional_brain_mask"],
+                     "requires": [], "cost": "high"}),
+        ("gcor", {"columns": ["gcor"],
+                  "inputs": ["func_motion_correct", "functional_brain_mask"],
+                  "requires": [], "cost": "low"})
+    ])
+}
+
+
+
+def select_measures(qap_type, measures=None):
+
+    '''
+    inputs
+        qap_type: 'anatomical_spatial', 'functional_spatial' or
+                  'functional_temporal'
+        measures: names of the measures to calculate (the 'measures'
+                  pipeline setting); None selects all of them
+
+    outputs
+        selected: the requested measures of this pipeline, plus the ones
+                  they are derived from, in registry order
+
+    Names of measures of the other pipelines are ignored, so one list can
+    be shared by all of them; names no pipeline knows raise an error.
+    '''
+
+    registry = QAP_MEASURES[qap_type]
+
+    if measures is None:
+        return list(registry.keys())
+
+    if isinstance(measures, str):
+        measures = [measures]
+
+    known = set()
+    for qap_measures in QAP_MEASURES.values():
+        known.update(qap_measures.keys())
+
+    unknown = [name for name in measures if name not in known]
+    if unknown:
+        err = "\n\n[!] Unknown QAP measure(s) %s, should be among: %s\n\n" \
+              % (", ".join(unknown), ", ".join(sorted(known)))
+        raise Exception(err)
+
+    wanted = set()
+    pending = [name for name in measures if name in registry]
+    while pending:
+        name = pending.pop()
+        if name not in wanted:
+            wanted.add(name)
+            pending.extend(registry[name]["requires"])
+
+    return [name for name in registry.keys() if name in wanted]
+
+
+
+def measure_inputs(qap_type, selected):
+
+    '''
+    inputs
+        qap_type: the pipeline the measures belong to
+        selected: measure names, as returned by select_measures
+
+    outputs
+        inputs: the set of resources the selected measures need loaded
+    '''
+
+    inputs = set()
+    for name in selected:
+        inputs.update(QAP_MEASURES[qap_type][name]["inputs"])
+
+    return inputs
+
+
+
+def skip_measures(qc, qap_type, selected, exclude=()):
+
+    '''
+    inputs
+        qc: the QC dictionary of a pipeline
+        qap_type: the pipeline the measures belong to
+        selected: the measures that are calculated
+        exclude: columns the pipeline does not write at all with its
+                 current settings (e.g. 'qi2' when it is not enabled)
+
+    outputs
+        qc: the QC dictionary, with the columns of every measure that is
+            not selected set to None
+    '''
+
+    for name, measure in QAP_MEASURES[qap_type].items():
+        if name in selected:
+            continue
+        for column in measure["columns"]:
+            if column not in exclude:
+                qc[column] = None
+
+    return qc
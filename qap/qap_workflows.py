@@ -14,11 +14,9 @@ def qap_mask_workflow(workflow, resource_pool, config):
     import nipype.pipeline.engine as pe
 
     import nipype.interfaces.utility as niu
-    import nipype.interfaces.fsl.maths as fsl
     from nipype.interfaces.fsl.base import Info
 
-    from qap_workflows_utils import select_thresh, \
-        slice_head_mask
+    from qap_workflows_utils import create_head_mask
 
     from workflow_utils import check_input_resources, \
         check_config_settings
@@ -46,63 +44,27 @@ def qap_mask_workflow(workflow, resource_pool, config):
         workflow, resource_pool = \
             anatomical_reorient_workflow(workflow, resource_pool, config)
 
-    select_thresh = pe.Node(niu.Function(
-        input_names=['input_skull'], output_names=['thresh_out'],
-        function=select_thresh), name='qap_headmask_select_thresh',
-        iterfield=['input_skull'])
-
-    mask_skull = pe.Node(
-        fsl.Threshold(args='-bin'), name='qap_headmask_thresh')
-
-    dilate_node = pe.Node(
-        fsl.MathsCommand(args='-dilM -dilM -dilM -dilM -dilM -dilM'),
-        name='qap_headmask_dilate')
-
-    erode_node = pe.Node(
-        fsl.MathsCommand(args='-eroF -eroF -eroF -eroF -eroF -eroF'),
-        name='qap_headmask_erode')
-
-    slice_head_mask = pe.Node(niu.Function(
-        input_names=['infile', 'transform', 'standard'],
-        output_names=['outfile_path'], function=slice_head_mask),
-        name='qap_headmask_slice_head_mask')
-
-    combine_masks = pe.Node(fsl.BinaryMaths(
-        operation='add', args='-bin'), name='qap_headmask_combine_masks')
+    head_mask = pe.Node(niu.Function(
+        input_names=['anatomical_reorient', 'transform', 'standard'],
+        output_names=['outfile_path'], function=create_head_mask),
+        name='qap_headmask')
 
     if len(resource_pool['anatomical_reorient']) == 2:
         node, out_file = resource_pool['anatomical_reorient']
-        workflow.connect([
-            (node, select_thresh,   [(out_file, 'input_skull')]),
-            (node, mask_skull,      [(out_file, 'in_file')]),
-            (node, slice_head_mask, [(out_file, 'infile')])
-        ])
+        workflow.connect(node, out_file, head_mask, 'anatomical_reorient')
     else:
-        select_thresh.inputs.input_skull = resource_pool['anatomical_reorient']
-        mask_skull.inputs.in_file = resource_pool['anatomical_reorient']
-        # convert_fsl_xfm.inputs.infile =
-        #    resource_pool['anatomical_reorient']
-        slice_head_mask.inputs.infile = resource_pool['anatomical_reorient']
+        head_mask.inputs.anatomical_reorient = \
+            resource_pool['anatomical_reorient']
 
     if len(resource_pool['flirt_affine_xfm']) == 2:
         node, out_file = resource_pool['flirt_affine_xfm']
-        workflow.connect(node, out_file, slice_head_mask, 'transform')
+        workflow.connect(node, out_file, head_mask, 'transform')
     else:
-        slice_head_mask.inputs.transform = resource_pool['flirt_affine_xfm']
-
-    # convert_fsl_xfm.inputs.standard = config['template_skull_for_anat']
-    slice_head_mask.inputs.standard = config['template_skull_for_anat']
+        head_mask.inputs.transform = resource_pool['flirt_affine_xfm']
 
-    workflow.connect([
-        (select_thresh, mask_skull,      [('thresh_out', 'thresh')]),
-        # (convert_fsl_xfm, slice_head_mask, [('converted_xfm', 'transform')])
-        (mask_skull, dilate_node,        [('out_file', 'in_file')]),
-        (dilate_node, erode_node,        [('out_file', 'in_file')]),
-        (erode_node, combine_masks,      [('out_file', 'in_file')]),
-        (slice_head_mask, combine_masks, [('outfile_path', 'operand_file')])
-    ])
+    head_mask.inputs.standard = config['template_skull_for_anat']
 
-    resource_pool['qap_head_mask'] = (combine_masks, 'out_file')
+    resource_pool['qap_head_mask'] = (head_mask, 'outfile_path')
     return workflow, resource_pool
 
 
@@ -173,18 +135,26 @@ def qap_anatomical_spatial_workflow(workflow, resource_pool, config,
     import nipype.interfaces.utility as niu
     import nipype.algorithms.misc as nam
     from qap_workflows_utils import qap_anatomical_spatial
+    from qap_utils import select_measures, measure_inputs
     from qap.viz.interfaces import PlotMosaic
 
-    if 'qap_head_mask' not in resource_pool.keys():
+    # the head mask and the segmentation are only built when one of the
+    # selected measures needs them
+    inputs = measure_inputs('anatomical_spatial', select_measures(
+        'anatomical_spatial', config.get('measures', None)))
+
+    if 'qap_head_mask' in inputs and \
+            'qap_head_mask' not in resource_pool.keys():
 
         from qap_workflows import qap_mask_workflow
 
         workflow, resource_pool = \
             qap_mask_workflow(workflow, resource_pool, config)
 
-    if ('anatomical_gm_mask' not in resource_pool.keys()) or \
-            ('anatomical_wm_mask' not in resource_pool.keys()) or \
-            ('anatomical_csf_mask' not in resource_pool.keys()):
+    if ('anatomical_gm_mask' in inputs) and \
+            (('anatomical_gm_mask' not in resource_pool.keys()) or
+             ('anatomical_wm_mask' not in resource_pool.keys()) or
+             ('anatomical_csf_mask' not in resource_pool.keys())):
 
         from anatomical_preproc import segmentation_workflow
 
@@ -200,10 +170,15 @@ def qap_anatomical_spatial_workflow(workflow, resource_pool, config,
         input_names=['anatomical_reorient', 'head_mask_path',
                      'anatomical_gm_mask', 'anatomical_wm_mask',
                      'anatomical_csf_mask', 'subject_id',
-                     'session_id', 'scan_id', 'site_name'],
+                     'session_id', 'scan_id', 'site_name', 'fwhm_method',
+                     'calculate_qi2', 'measures'],
         output_names=['qc'], function=qap_anatomical_spatial),
         name='qap_anatomical_spatial')
 
+    spatial.inputs.fwhm_method = config.get('fwhm_method', 'native')
+    spatial.inputs.calculate_qi2 = config.get('calculate_qi2', False)
+    spatial.inputs.measures = config.get('measures', None)
+
     # Subject infos
     spatial.inputs.subject_id = config['subject_id']
     spatial.inputs.session_id = config['session_id']
@@ -219,32 +194,23 @@ def qap_anatomical_spatial_workflow(workflow, resource_pool, config,
         spatial.inputs.anatomical_reorient = \
             resource_pool['anatomical_reorient']
 
-    if len(resource_pool['qap_head_mask']) == 2:
+    if 'qap_head_mask' not in inputs:
+        spatial.inputs.head_mask_path = None
+    elif len(resource_pool['qap_head_mask']) == 2:
         node, out_file = resource_pool['qap_head_mask']
         workflow.connect(node, out_file, spatial, 'head_mask_path')
     else:
         spatial.inputs.head_mask_path = resource_pool['qap_head_mask']
 
-    if len(resource_pool['anatomical_gm_mask']) == 2:
-        node, out_file = resource_pool['anatomical_gm_mask']
-        workflow.connect(node, out_file, spatial, 'anatomical_gm_mask')
-    else:
-        spatial.inputs.anatomical_gm_mask = \
-            resource_pool['anatomical_gm_mask']
-
-    if len(resource_pool['anatomical_wm_mask']) == 2:
-        node, out_file = resource_pool['anatomical_wm_mask']
-        workflow.connect(node, out_file, spatial, 'anatomical_wm_mask')
-    else:
-        spatial.inputs.anatomical_wm_mask = \
-            resource_pool['anatomical_wm_mask']
-
-    if len(resource_pool['anatomical_csf_mask']) == 2:
-        node, out_file = resource_pool['anatomical_csf_mask']
-        workflow.connect(node, out_file, spatial, 'anatomical_csf_mask')
-    else:
-        spatial.inputs.anatomical_csf_mask = \
-            resource_pool['anatomical_csf_mask']
+    for tissue_mask in ('anatomical_gm_mask', 'anatomical_wm_mask',
+                        'anatomical_csf_mask'):
+        if tissue_mask not in inputs:
+            setattr(spatial.inputs, tissue_mask, None)
+        elif len(resource_pool[tissue_mask]) == 2:
+            node, out_file = resource_pool[tissue_mask]
+            workflow.connect(node, out_file, spatial, tissue_mask)
+        else:
+            setattr(spatial.inputs, tissue_mask, resource_pool[tissue_mask])
 
     if config.get('write_report', False):
         plot = pe.Node(PlotMosaic(), name='plot_mosaic')
@@ -372,10 +338,14 @@ def qap_functional_spatial_workflow(workflow, resource_pool, config):
 
     spatial_epi = pe.Node(niu.Function(
         input_names=['mean_epi', 'func_brain_mask', 'direction', 'subject_id',
-                     'session_id', 'scan_id', 'site_name'],
+                     'session_id', 'scan_id', 'site_name', 'fwhm_method',
+                     'measures'],
         output_names=['qc'], function=qap_functional_spatial),
         name='qap_functional_spatial')
 
+    spatial_epi.inputs.fwhm_method = config.get('fwhm_method', 'native')
+    spatial_epi.inputs.measures = config.get('measures', None)
+
     # Subject infos
     if 'ghost_direction' not in config.keys():
         config['ghost_direction'] = 'y'
@@ -545,10 +515,16 @@ def qap_functional_temporal_workflow(workflow, resource_pool, config):
             fd.inputs.in_file = resource_pool['coordinate_transformation']
 
     temporal = pe.Node(niu.Function(
-        input_names=['func_motion_correct', 'func_brain_mask', 'tsnr_volume',
-                     'fd_file', 'subject_id', 'session_id',
-                     'scan_id', 'site_name'], output_names=['qc'],
+        input_names=['func_motion_correct', 'func_brain_mask', 'fd_file',
+                     'subject_id', 'session_id', 'scan_id', 'site_name',
+                     'outlier_method', 'quality_method',
+                     'dvars_block_size', 'measures'],
+        output_names=['qc'],
         function=qap_functional_temporal), name='qap_functional_temporal')
+    temporal.inputs.outlier_method = config.get('outlier_method', 'native')
+    temporal.inputs.quality_method = config.get('quality_method', 'native')
+    temporal.inputs.dvars_block_size = config.get('dvars_block_size', None)
+    temporal.inputs.measures = config.get('measures', None)
     temporal.inputs.subject_id = config['subject_id']
     temporal.inputs.session_id = config['session_id']
     temporal.inputs.scan_id = config['scan_id']
@@ -557,17 +533,14 @@ def qap_functional_temporal_workflow(workflow, resource_pool, config):
     if 'site_name' in config.keys():
         temporal.inputs.site_name = config['site_name']
 
-    tsnr = pe.Node(nam.TSNR(), name='compute_tsnr')
     if len(resource_pool['func_motion_correct']) == 2:
         node, out_file = resource_pool['func_motion_correct']
-        workflow.connect(node, out_file, tsnr, 'in_file')
         workflow.connect(node, out_file, temporal, 'func_motion_correct')
     else:
         from workflow_utils import check_input_resources
         check_input_resources(resource_pool, 'func_motion_correct')
-        input_file = resource_pool['func_motion_correct']
-        tsnr.inputs.in_file = input_file
-        temporal.inputs.func_motion_correct = input_file
+        temporal.inputs.func_motion_correct = \
+            resource_pool['func_motion_correct']
 
     if len(resource_pool['functional_brain_mask']) == 2:
         node, out_file = resource_pool['functional_brain_mask']
@@ -578,6 +551,15 @@ def qap_functional_temporal_workflow(workflow, resource_pool, config):
 
     # Write mosaic and FD plot
     if config.get('write_report', False):
+        # the tSNR measure itself comes from the temporal node; the volume
+        # is only needed for the mosaic
+        tsnr = pe.Node(nam.TSNR(), name='compute_tsnr')
+        if len(resource_pool['func_motion_correct']) == 2:
+            node, out_file = resource_pool['func_motion_correct']
+            workflow.connect(node, out_file, tsnr, 'in_file')
+        else:
+            tsnr.inputs.in_file = resource_pool['func_motion_correct']
+
         plot = pe.Node(PlotMosaic(), name='plot_mosaic')
         plot.inputs.subject = config['subject_id']
 
@@ -608,7 +590,6 @@ def qap_functional_temporal_workflow(workflow, resource_pool, config):
     temporal_to_csv = pe.Node(
         nam.AddCSVRow(in_file=out_csv), name='qap_functional_temporal_to_csv')
 
-    workflow.connect(tsnr, 'tsnr_file', temporal, 'tsnr_volume')
     workflow.connect(temporal, 'qc', temporal_to_csv, '_outputs')
     resource_pool['qap_functional_temporal'] = (temporal_to_csv, 'csv_file')
     return workflow, resource_pool
@@ -1,58 +1,98 @@
 
 
-def select_thresh(input_skull):
+def hist_thresh(skull_data, nbins=10):
 
-    import os
-    import commands
+    import numpy as np
 
-    avg_in = "3dmaskave %s" % input_skull
+    '''
+    inputs
+        skull_data: the (skull-on) anatomical image data
+        nbins: number of histogram bins
 
-    avg_out = commands.getoutput(avg_in)
+    outputs
+        thresh_out: the lower edge of the least populated (non-empty) bin of
+                    the intensity histogram between the image minimum and
+                    three times the image average (or the image maximum,
+                    for images whose average is too low to span a range),
+                    as 3dmaskave and 3dHist used to give; of equally small
+                    bins, the highest wins
+    '''
 
-    avg = int(float(avg_out.split("\n")[-1].split(" ")[0]))
-    max_limit = int(avg * 3)
+    max_limit = 3 * float(skull_data.mean())
+
+    if max_limit <= skull_data.min():
+        max_limit = skull_data.max()
 
     # get the voxel intensity bins
-    cmd_in = "3dHist -input %s -nbin 10 -max %d -showhist" % \
-             (input_skull, max_limit)
+    counts, edges = np.histogram(skull_data, bins=nbins,
+                                 range=(skull_data.min(), max_limit))
 
-    cmd_out = commands.getoutput(cmd_in)
+    nonempty = np.nonzero(counts)[0]
+    least = nonempty[counts[nonempty] == counts[nonempty].min()]
 
-    os.system("rm HistOut.niml.hist")
+    thresh_out = int(edges[least[-1]])
 
-    bins = {}
+    return thresh_out
 
-    for line in cmd_out.split("\n"):
 
-        if "*" in line and not line.startswith("*"):
+def select_thresh(input_skull):
 
-            vox_bin = line.replace(" ", "").split(":")[0]
+    from qap.qap_utils import load_image_data
+    from qap.qap_workflows_utils import hist_thresh
 
-            voxel_value = int(float(vox_bin.split(",")[0]))
+    thresh_out = hist_thresh(load_image_data(input_skull))
 
-            bins[int(vox_bin.split(",")[1])] = voxel_value
+    return thresh_out
 
-    thresh_out = bins[min(bins.keys())]
 
-    return thresh_out
+def fsl_voxel_scaling(img):
 
+    import numpy as np
 
-def slice_head_mask(infile, transform, standard):
+    '''
+    inputs
+        img: a loaded (Nibabel) image
 
-    import os
-    import sys
+    outputs
+        scaling: 4x4 matrix taking voxel indices to FSL's "scaled voxel"
+                 coordinates, the space FLIRT matrices are defined in (voxel
+                 sizes, with the x axis flipped for images stored in
+                 neurological orientation)
+    '''
+
+    zooms = img.get_header().get_zooms()[:3]
+    scaling = np.diag(list(zooms) + [1.0])
+
+    if np.linalg.det(img.get_affine()) > 0:
+        flip = np.eye(4)
+        flip[0, 0] = -1
+        flip[0, 3] = img.shape[0] - 1
+        scaling = scaling.dot(flip)
+
+    return scaling
+
+
+def slice_plane_mask(infile_img, transform, standard):
 
     import nibabel as nb
     import numpy as np
-    import subprocess
     import pkg_resources as p
+    from nibabel.affines import apply_affine
 
-    # get file info
-    infile_img = nb.load(infile)
-    infile_header = infile_img.get_header()
-    infile_affine = infile_img.get_affine()
+    from qap.qap_workflows_utils import fsl_voxel_scaling
+
+    '''
+    inputs
+        infile_img: the loaded (Nibabel) anatomical image
+        transform: FLIRT matrix from the anatomical to the standard image
+        standard: path to the standard (MNI) image
+
+    outputs
+        mask_array: boolean array, True below the plane through the three
+                    MNI inpoints (the neck and lower face)
+    '''
 
-    infile_dims = infile_header.get_data_shape()
+    infile_dims = infile_img.get_header().get_data_shape()[:3]
 
     # these are stored in the files listed below, just here for reference
     inpoint_a = "78 -110 -72"
@@ -65,63 +105,27 @@ def slice_head_mask(infile, transform, standard):
                      p.resource_filename("qap", "inpoint_b.txt"),
                      p.resource_filename("qap", "inpoint_c.txt")]
 
-    # let's convert the coordinates into voxel coordinates
+    inpoints = np.array([np.loadtxt(inpoint) for inpoint in inpoint_files])
 
-    coords = []
+    # let's convert the (standard space, mm) coordinates into voxel
+    # coordinates of the input image, as std2imgcoord does: standard mm ->
+    # standard voxels -> FSL scaled voxels -> through the inverse of the
+    # FLIRT matrix (input -> standard) -> input voxels
+    standard_img = nb.load(standard)
+    flirt_xfm = np.loadtxt(transform)
 
-    for inpoint in inpoint_files:
+    std2img = np.linalg.inv(fsl_voxel_scaling(infile_img)).dot(
+        np.linalg.inv(flirt_xfm)).dot(
+        fsl_voxel_scaling(standard_img)).dot(
+        np.linalg.inv(standard_img.get_affine()))
 
-        coord_cmd = "std2imgcoord -img %s -std %s -xfm %s -vox %s" \
-                    % (infile, standard, transform, inpoint)
-
-        coord_out = subprocess.check_output(coord_cmd, shell=True)
-
-        if "Could not" in coord_out:
-            raise Exception(coord_out)
-
-        coords.append(coord_out)
-
-    # get the converted coordinates into a list format, and also check to make
-    # sure they are not "out of bounds"
-    new_coords = []
-
-    for coord in coords:
-
-        co_nums = coord.split(" ")
-
-        co_nums_newlist = []
-
-        for num in co_nums:
-
-            if num != "":
-                co_nums_newlist.append(int(num.split(".")[0]))
-
-        for ind in range(0, 3):
-
-            if co_nums_newlist[ind] > infile_dims[ind]:
-                co_nums_newlist[ind] = infile_dims[ind]
-
-            elif co_nums_newlist[ind] < 1:
-                co_nums_newlist[ind] = 1
-
-        new_coords.append(co_nums_newlist)
+    # truncate to integer voxels and make sure they are not "out of bounds"
+    new_coords = np.trunc(apply_affine(std2img, inpoints)).astype(int)
+    new_coords = np.clip(new_coords, 1, infile_dims)
 
     # get the vectors connecting the points
-
-    u = []
-
-    for a_pt, c_pt in zip(new_coords[0], new_coords[2]):
-
-        u.append(int(a_pt - c_pt))
-
-    v = []
-
-    for b_pt, c_pt in zip(new_coords[1], new_coords[2]):
-
-        v.append(int(b_pt - c_pt))
-
-    u_vector = np.asarray(u)
-    v_vector = np.asarray(v)
+    u = new_coords[0] - new_coords[2]
+    v = new_coords[1] - new_coords[2]
 
     # vector cross product
     n = np.cross(u, v)
@@ -129,37 +133,39 @@ def slice_head_mask(infile, transform, standard):
     # normalize the vector
     n = n / np.linalg.norm(n, 2)
 
-    constant = np.dot(n, np.asarray(new_coords[0]))
+    constant = np.dot(n, new_coords[0])
 
     # now determine the z-coordinate for each pair of x,y
-    plane_dict = {}
+    xvox = np.arange(infile_dims[0])[:, np.newaxis]
+    yvox = np.arange(infile_dims[1])[np.newaxis, :]
 
-    for yvox in range(0, infile_dims[1]):
+    plane_z = np.floor((constant - (n[0] * xvox + n[1] * yvox)) / n[2])
+    plane_z = np.clip(plane_z, 1, infile_dims[2])
 
-        for xvox in range(0, infile_dims[0]):
+    # create the mask: everything below the plane
+    zvox = np.arange(infile_dims[2])
+    mask_array = plane_z[:, :, np.newaxis] > zvox
 
-            zvox = (constant - (n[0] * xvox + n[1] * yvox)) / n[2]
+    return mask_array
 
-            zvox = np.floor(zvox)
 
-            if zvox < 1:
-                zvox = 1
-            elif zvox > infile_dims[2]:
-                zvox = infile_dims[2]
-
-            plane_dict[(xvox, yvox)] = zvox
+def slice_head_mask(infile, transform, standard):
 
-    # create the mask
-    mask_array = np.zeros(infile_dims)
+    import os
+    import sys
 
-    for x in range(0, infile_dims[0]):
+    import nibabel as nb
+    import numpy as np
 
-        for y in range(0, infile_dims[1]):
+    from qap.qap_workflows_utils import slice_plane_mask
 
-            for z in range(0, infile_dims[2]):
+    # get file info
+    infile_img = nb.load(infile)
+    infile_header = infile_img.get_header()
+    infile_affine = infile_img.get_affine()
 
-                if plane_dict[(x, y)] > z:
-                    mask_array[x, y, z] = 1
+    mask_array = slice_plane_mask(infile_img, transform, standard)
+    mask_array = mask_array.astype(np.float64)
 
     new_mask_img = nb.Nifti1Image(mask_array, infile_affine, infile_header)
 
@@ -173,26 +179,104 @@ def slice_head_mask(infile, transform, standard):
     return outfile_path
 
 
+def create_head_mask(anatomical_reorient, transform, standard,
+                     n_dilations=6, n_erosions=6):
+
+    import os
+
+    import nibabel as nb
+    import numpy as np
+    import scipy.ndimage as nd
+
+    from qap.qap_utils import load_image_data
+    from qap.qap_workflows_utils import hist_thresh, slice_plane_mask
+
+    '''
+    inputs
+        anatomical_reorient: the (skull-on) anatomical image
+        transform: FLIRT matrix from the anatomical to the standard image
+        standard: path to the standard (MNI) image
+        n_dilations, n_erosions: number of 3x3x3 dilation and erosion
+                                 passes closing the thresholded head
+
+    outputs
+        outfile_path: the binary head mask
+
+    The fslmaths chain (threshold and binarize, -dilM and -eroF passes,
+    union with the slice mask) is run on one in-memory array; only the
+    final mask is written.
+    '''
+
+    infile_img = nb.load(anatomical_reorient)
+    infile_data = load_image_data(anatomical_reorient)
+
+    # threshold and binarize (fslmaths -thr -bin)
+    thresh = hist_thresh(infile_data)
+    mask_array = (infile_data >= thresh) & (infile_data != 0)
+    del infile_data
+
+    # fill the head: dilation (-dilM) followed by erosion (-eroF) with the
+    # default fslmaths 3x3x3 box kernel; like a minimum filter, the erosion
+    # does not eat into the mask from outside the field of view
+    kernel = np.ones((3, 3, 3), dtype=bool)
+    mask_array = nd.binary_dilation(mask_array, structure=kernel,
+                                    iterations=n_dilations)
+    mask_array = nd.binary_erosion(mask_array, structure=kernel,
+                                   iterations=n_erosions, border_value=1)
+
+    # add the plane below the head
+    mask_array |= slice_plane_mask(infile_img, transform, standard)
+
+    header = infile_img.get_header().copy()
+    header.set_data_dtype(np.uint8)
+    new_mask_img = nb.Nifti1Image(mask_array.astype(np.uint8),
+                                  infile_img.get_affine(), header)
+
+    infile_filename = anatomical_reorient.split("/")[-1].split(".")[0]
+
+    outfile_name = infile_filename + "_head_mask.nii.gz"
+    outfile_path = os.path.join(os.getcwd(), outfile_name)
+
+    nb.save(new_mask_img, outfile_path)
+
+    return outfile_path
+
+
 def qap_anatomical_spatial(anatomical_reorient, head_mask_path,
                            anatomical_gm_mask, anatomical_wm_mask,
                            anatomical_csf_mask, subject_id, session_id,
-                           scan_id, site_name=None, out_vox=True):
+                           scan_id, site_name=None, out_vox=True,
+                           fwhm_method="native", calculate_qi2=False,
+                           measures=None):
 
     import os
     import sys
 
-    from qap.spatial_qc import summary_mask, snr, cnr, fber, efc, \
-        artifacts, fwhm
-    from qap.qap_utils import load_image, load_mask
+    from qap.spatial_qc import summary_masks, snr, cnr, efc, artifacts, \
+        fwhm, calc_fwhm
+    from qap.qap_utils import load_image, load_mask, get_pixdim, \
+        select_measures, measure_inputs, skip_measures
+
+    # Only the selected measures are calculated, and only the inputs they
+    # need are loaded
+    selected = select_measures("anatomical_spatial", measures)
+    inputs = measure_inputs("anatomical_spatial", selected)
 
     # Load the data
-    anat_data = load_image(anatomical_reorient)
-    fg_mask = load_mask(head_mask_path, anatomical_reorient)
-    bg_mask = 1 - fg_mask
+    anat_data, n_negative = load_image(anatomical_reorient,
+                                       return_clipped=True)
 
-    gm_mask = load_mask(anatomical_gm_mask, anatomical_reorient)
-    wm_mask = load_mask(anatomical_wm_mask, anatomical_reorient)
-    csf_mask = load_mask(anatomical_csf_mask, anatomical_reorient)
+    if "qap_head_mask" in inputs:
+        fg_mask = load_mask(head_mask_path, anatomical_reorient)
+
+    tissue_masks = dict()
+    if "anatomical_gm_mask" in inputs:
+        tissue_masks['gm'] = load_mask(anatomical_gm_mask,
+                                       anatomical_reorient)
+        tissue_masks['wm'] = load_mask(anatomical_wm_mask,
+                                       anatomical_reorient)
+        tissue_masks['csf'] = load_mask(anatomical_csf_mask,
+                                        anatomical_reorient)
 
     # Initialize QC
     qc = dict()
@@ -206,62 +290,81 @@ def qap_anatomical_spatial(anatomical_reorient, head_mask_path,
     if site_name:
         qc['site'] = site_name
 
+    # Skipped measures keep their (empty) columns
+    skip_measures(qc, "anatomical_spatial", selected,
+                  exclude=() if calculate_qi2 else ('qi2',))
+
+    # Summary Measures of every mask (and the energies for FBER) from a
+    # single labelled pass over the volume
+    if "summary" in selected:
+        summary = summary_masks(anat_data, fg_mask, tissue_masks)
+
+        for tissue in ['fg', 'bg'] + sorted(tissue_masks.keys()):
+            qc['%s_mean' % tissue], qc['%s_std' % tissue], \
+                qc['%s_size' % tissue], _ = summary[tissue]
+
     # FBER
-    qc['fber'] = fber(anat_data, fg_mask)
+    if "fber" in selected:
+        qc['fber'] = summary['fg'][3] / summary['bg'][3]
 
     # EFC
-    qc['efc'] = efc(anat_data)
+    if "efc" in selected:
+        qc['efc'] = efc(anat_data)
+
+    # Negative voxels found in the image
+    qc['negative_voxels'] = n_negative
 
     # Artifact
-    qc['qi1'], _ = artifacts(anat_data, fg_mask, calculate_qi2=False)
+    if "qi1" in selected:
+        qc['qi1'], qi2 = artifacts(anat_data, fg_mask,
+                                   calculate_qi2=calculate_qi2)
 
-    # Smoothness in voxels
-    tmp = fwhm(anatomical_reorient, head_mask_path, out_vox=out_vox)
-    qc['fwhm_x'], qc['fwhm_y'], qc['fwhm_z'], qc['fwhm'] = tmp
+        if calculate_qi2:
+            qc['qi2'] = qi2
 
-    # Summary Measures
-    qc['fg_mean'], qc['fg_std'], qc[
-        'fg_size'] = summary_mask(anat_data, fg_mask)
-    qc['bg_mean'], qc['bg_std'], qc[
-        'bg_size'] = summary_mask(anat_data, bg_mask)
-
-    qc['gm_mean'], qc['gm_std'], qc['gm_size'] = (None, None, None)
-    qc['wm_mean'], qc['wm_std'], qc['wm_size'] = (None, None, None)
-    qc['csf_mean'], qc['csf_std'], qc['csf_size'] = (None, None, None)
-    qc['cnr'] = None
-    qc['snr'] = None
-
-    # More Summary Measures
-    qc['gm_mean'], qc['gm_std'], qc[
-        'gm_size'] = summary_mask(anat_data, gm_mask)
-    qc['wm_mean'], qc['wm_std'], qc[
-        'wm_size'] = summary_mask(anat_data, wm_mask)
-    qc['csf_mean'], qc['csf_std'], qc[
-        'csf_size'] = summary_mask(anat_data, csf_mask)
+    # Smoothness in voxels
+    if "fwhm" in selected:
+        if fwhm_method == "afni":
+            tmp = fwhm(anatomical_reorient, head_mask_path, out_vox=out_vox)
+        else:
+            tmp = calc_fwhm(anat_data, fg_mask,
+                            get_pixdim(anatomical_reorient), out_vox=out_vox)
+        qc['fwhm_x'], qc['fwhm_y'], qc['fwhm_z'], qc['fwhm'] = tmp
 
     # SNR
-    qc['snr'] = snr(qc['fg_mean'], qc['bg_std'])
+    if "snr" in selected:
+        qc['snr'] = snr(qc['fg_mean'], qc['bg_std'])
 
     # CNR
-    qc['cnr'] = cnr(qc['gm_mean'], qc['wm_mean'], qc['bg_std'])
+    if "cnr" in selected:
+        qc['cnr'] = cnr(qc['gm_mean'], qc['wm_mean'], qc['bg_std'])
     return qc
 
 
 def qap_functional_spatial(mean_epi, func_brain_mask, direction, subject_id,
                            session_id, scan_id, site_name=None,
-                           out_vox=True):
+                           out_vox=True, fwhm_method="native",
+                           measures=None):
 
     import os
     import sys
 
     from qap.spatial_qc import summary_mask, snr, fber, efc, fwhm, \
-        ghost_direction
-    from qap.qap_utils import load_image, load_mask
+        calc_fwhm, ghost_direction, ghost_directions
+    from qap.qap_utils import load_image, load_mask, get_pixdim, \
+        select_measures, measure_inputs, skip_measures
+
+    # Only the selected measures are calculated, and only the inputs they
+    # need are loaded
+    selected = select_measures("functional_spatial", measures)
+    inputs = measure_inputs("functional_spatial", selected)
 
     # Load the data
-    anat_data = load_image(mean_epi)
-    fg_mask = load_mask(func_brain_mask, mean_epi)
-    bg_mask = 1 - fg_mask
+    anat_data, n_negative = load_image(mean_epi, return_clipped=True)
+
+    if "functional_brain_mask" in inputs:
+        fg_mask = load_mask(func_brain_mask, mean_epi)
+        bg_mask = 1 - fg_mask
 
     # Initialize QC
     qc = dict(subject=subject_id, session=session_id, scan=scan_id)
@@ -269,96 +372,131 @@ def qap_functional_spatial(mean_epi, func_brain_mask, direction, subject_id,
     if site_name:
         qc['site'] = site_name
 
+    # Skipped measures keep their (empty) columns
+    skip_measures(qc, "functional_spatial", selected,
+                  exclude=['ghost_%s' % axis for axis in ("x", "y", "z")
+                           if direction not in (axis, "all")])
+
     # FBER
-    qc['fber'] = fber(anat_data, fg_mask)
+    if "fber" in selected:
+        qc['fber'] = fber(anat_data, fg_mask)
 
     # EFC
-    qc['efc'] = efc(anat_data)
+    if "efc" in selected:
+        qc['efc'] = efc(anat_data)
+
+    # Negative voxels found in the image
+    qc['negative_voxels'] = n_negative
 
     # Smoothness in voxels
-    tmp = fwhm(mean_epi, func_brain_mask, out_vox=out_vox)
-    qc['fwhm_x'], qc['fwhm_y'], qc['fwhm_z'], qc['fwhm'] = tmp
+    if "fwhm" in selected:
+        if fwhm_method == "afni":
+            tmp = fwhm(mean_epi, func_brain_mask, out_vox=out_vox)
+        else:
+            tmp = calc_fwhm(anat_data, fg_mask, get_pixdim(mean_epi),
+                            out_vox=out_vox)
+        qc['fwhm_x'], qc['fwhm_y'], qc['fwhm_z'], qc['fwhm'] = tmp
 
     # Ghosting
-    if (direction == "all"):
-        qc['ghost_x'] = ghost_direction(anat_data, fg_mask, "x")
-        qc['ghost_y'] = ghost_direction(anat_data, fg_mask, "y")
-        qc['ghost_z'] = ghost_direction(anat_data, fg_mask, "z")
+    if "ghost" in selected and direction == "all":
+        qc['ghost_x'], qc['ghost_y'], qc['ghost_z'] = \
+            ghost_directions(anat_data, fg_mask, ("x", "y", "z"))
 
-    else:
+    elif "ghost" in selected:
         qc['ghost_%s' % direction] = ghost_direction(anat_data, fg_mask,
                                                      direction)
 
     # Summary Measures
-    qc['fg_mean'], qc['fg_std'], qc[
-        'fg_size'] = summary_mask(anat_data, fg_mask)
-    qc['bg_mean'], qc['bg_std'], qc[
-        'bg_size'] = summary_mask(anat_data, bg_mask)
-
-    qc['snr'] = None
+    if "summary" in selected:
+        qc['fg_mean'], qc['fg_std'], qc[
+            'fg_size'] = summary_mask(anat_data, fg_mask)
+        qc['bg_mean'], qc['bg_std'], qc[
+            'bg_size'] = summary_mask(anat_data, bg_mask)
 
     # SNR
-    qc['snr'] = snr(qc['fg_mean'], qc['bg_std'])
+    if "snr" in selected:
+        qc['snr'] = snr(qc['fg_mean'], qc['bg_std'])
     return qc
 
 
 def qap_functional_temporal(
-        func_motion_correct, func_brain_mask, tsnr_volume, fd_file,
-        subject_id, session_id, scan_id, site_name=None, motion_threshold=1.0):
+        func_motion_correct, func_brain_mask, fd_file, subject_id,
+        session_id, scan_id, site_name=None, motion_threshold=1.0,
+        outlier_method="native", quality_method="native",
+        dvars_block_size=None, measures=None):
 
     import sys
     import nibabel as nb
     import numpy as np
 
-    from qap.temporal_qc import mean_dvars_wrapper, mean_outlier_timepoints, \
-        mean_quality_timepoints, global_correlation
+    from qap.temporal_qc import temporal_metrics, mean_outlier_timepoints, \
+        mean_quality_timepoints, load_fd
+    from qap.qap_utils import select_measures, skip_measures
 
-    # DVARS
-    mean_dvars = mean_dvars_wrapper(func_motion_correct, func_brain_mask)
+    for method in (outlier_method, quality_method):
+        if method not in ("native", "afni"):
+            err = "\n\n[!] Unknown temporal QC method '%s', should be " \
+                  "'native' or 'afni'.\n\n" % method
+            raise Exception(err)
 
-    # Mean FD (Jenkinson)
-    fd = np.loadtxt(fd_file)
-
-    # Calculate Outliers
-    # Number and Percent of frames (time points) where
-    # movement (FD) exceeded threshold
-    num_fd = np.float((fd > motion_threshold).sum())
-    percent_fd = (num_fd * 100) / (len(fd) + 1)
-
-    # 3dTout
-    mean_outlier = mean_outlier_timepoints(func_motion_correct,
-                                           func_brain_mask)
-
-    # 3dTqual
-    mean_quality = mean_quality_timepoints(func_motion_correct)
-
-    # new thing
-    gcor = global_correlation(func_motion_correct, func_brain_mask)
-
-    # tSNR
-    tsnr_data = nb.load(tsnr_volume).get_data()
-    msk_data = np.ones_like(tsnr_data)
-    try:
-        msk_data = nb.load(func_brain_mask).get_data()
-    except:
-        pass
-
-    # Compile
-    qc = {
-        "subject":   subject_id,
-        "session":   session_id,
-        "scan":      scan_id,
-        "dvars":     mean_dvars,
-        "m_tsnr":    np.median(tsnr_data[msk_data > 0]),
-        "mean_fd":   fd.mean(),
-        'num_fd':    num_fd,
-        'perc_fd':   percent_fd,
-        "outlier":   mean_outlier,
-        "quality":   mean_quality,
-        "gcor":      gcor
-    }
+    # Only the selected measures are calculated
+    selected = select_measures("functional_temporal", measures)
+
+    # Initialize QC; skipped measures keep their (empty) columns
+    qc = dict(subject=subject_id, session=session_id, scan=scan_id)
 
     if site_name:
         qc['site'] = site_name
 
+    skip_measures(qc, "functional_temporal", selected)
+
+    # DVARS, GCOR, tSNR, outliers and quality from a single load of the
+    # functional data, which is skipped when none of them is selected
+    outliers = "outlier" in selected and outlier_method == "native"
+    quality = "quality" in selected and quality_method == "native"
+
+    if outliers or quality or \
+            set(selected) & set(["dvars", "tsnr", "gcor"]):
+        metrics = temporal_metrics(func_motion_correct, func_brain_mask,
+                                   outliers=outliers, quality=quality,
+                                   dvars_block_size=dvars_block_size,
+                                   dvars=("dvars" in selected),
+                                   gcor=("gcor" in selected))
+
+    if "dvars" in selected:
+        qc['dvars'] = metrics["dvars"]
+
+    if "tsnr" in selected:
+        qc['m_tsnr'] = metrics["m_tsnr"]
+
+    if "gcor" in selected:
+        qc['gcor'] = metrics["gcor"]
+
+    # Mean FD (Jenkinson)
+    if "fd" in selected:
+        fd = load_fd(fd_file)
+
+        # Calculate Outliers
+        # Number and Percent of frames (time points) where
+        # movement (FD) exceeded threshold
+        num_fd = np.float((fd > motion_threshold).sum())
+        percent_fd = (num_fd * 100) / (len(fd) + 1)
+
+        qc['mean_fd'] = fd.mean()
+        qc['num_fd'] = num_fd
+        qc['perc_fd'] = percent_fd
+
+    # Outliers (3dTout)
+    if "outlier" in selected and outlier_method == "afni":
+        qc['outlier'] = mean_outlier_timepoints(func_motion_correct,
+                                                func_brain_mask)
+    elif "outlier" in selected:
+        qc['outlier'] = metrics["outlier"]
+
+    # Quality index (3dTqual)
+    if "quality" in selected and quality_method == "afni":
+        qc['quality'] = mean_quality_timepoints(func_motion_correct)
+    elif "quality" in selected:
+        qc['quality'] = metrics["quality"]
+
     return qc
@@ -41,6 +41,92 @@ def summary_mask(anat_data, mask_data):
 
 
 
+def summary_masks(anat_data, fg_mask_data, masks=None, chunk_size=8):
+
+    """
+    Calculate the summary measures (mean, stdev, size and mean energy) of
+    the foreground, the background and any further masks at once.
+    
+    The masks are combined into one label image, with one bit per mask, and
+    the count, sum and energy of every label are accumulated with bincount
+    (plus the squared deviations from the label means, for a stable
+    standard deviation). The measures of each mask are then derived from
+    the labels it covers, so the volume is never indexed or copied per
+    mask. The label image is built and reduced `chunk_size` slices at a
+    time.
+    
+    Paramaters
+    ----------
+    anat_data: np.array
+    fg_mask_data: np.array
+        foreground mask, the background is everything outside of it
+    masks: dict
+        additional masks (e.g. tissue masks) keyed by name; at most 7
+    chunk_size: int
+        number of slices along the last axis processed at a time
+    
+    Returns (dict)
+    -------
+    summary: dict of (mean, std, size, energy) tuples
+        keyed by 'fg', 'bg' and the names in `masks`, where energy is the
+        mean squared intensity inside the mask
+    """
+    
+    import numpy as np
+
+    if masks is None:
+        masks = {}
+
+    names = sorted(masks.keys())
+    n_labels = 2 ** (len(names) + 1)
+
+    counts = np.zeros(n_labels)
+    sums = np.zeros(n_labels)
+    energy = np.zeros(n_labels)
+    sq_dev = np.zeros(n_labels)
+
+    def _label_chunks():
+        for start in range(0, anat_data.shape[-1], chunk_size):
+            chunk = (Ellipsis, slice(start, start + chunk_size))
+            label = (fg_mask_data[chunk] == 1).astype(np.uint8)
+            for bit, name in enumerate(names, 1):
+                label |= (masks[name][chunk] == 1).astype(np.uint8) << bit
+            yield label.ravel(), anat_data[chunk].ravel().astype(np.float64)
+
+    for label, data in _label_chunks():
+        counts += np.bincount(label, minlength=n_labels)
+        sums += np.bincount(label, weights=data, minlength=n_labels)
+        energy += np.bincount(label, weights=data ** 2, minlength=n_labels)
+
+    label_means = sums / np.maximum(counts, 1)
+
+    for label, data in _label_chunks():
+        sq_dev += np.bincount(label, weights=(data - label_means[label]) ** 2,
+                              minlength=n_labels)
+
+    def _summary(selected):
+        size = counts[selected].sum()
+        mean = sums[selected].sum() / size
+        # pool the within-label and between-label squared deviations
+        ss = sq_dev[selected].sum() + \
+            (counts[selected] * (label_means[selected] - mean) ** 2).sum()
+        std = np.sqrt(ss / (size - 1))
+        return (mean, std, int(size), energy[selected].sum() / size)
+
+    labels = np.arange(n_labels)
+
+    summary = {
+        'fg': _summary((labels & 1) == 1),
+        'bg': _summary((labels & 1) == 0)
+    }
+
+    for bit, name in enumerate(names, 1):
+        summary[name] = _summary(((labels >> bit) & 1) == 1)
+
+    return summary
+
+
+
 def get_background(anat_data, fg_mask_data):
 
     # Define the image background by taking the inverse of the
@@ -76,27 +162,53 @@ def check_datatype(background):
               "floating point: %s" % background.dtype
         raise TypeError
         
-    # convert any negative voxel values to zero, provide warning
-    for vox in background.flatten():
-        if vox < 0:
-            print "\nWARNING: Negative voxel values in anatomical scan " \
-                  "converted to zero.\n"
-            background = background.clip(0)
-            break
+    # convert any negative voxel values to zero (the background is already
+    # a copy of the image)
+    background, _ = clip_negatives(background, in_place=True)
 
     return background
 
 
 
+def clip_negatives(img_data, in_place=False):
+
+    """
+    Set negative voxel values to zero.
+
+    Parameters
+    ----------
+    img_data: np.array
+    in_place: bool (default: False)
+        Whether to zero the negative voxels in img_data itself (when it is
+        writeable) rather than in a copy
+
+    Returns
+    -------
+    img_data: np.array
+        img_data, or a clipped copy of it if it had negative voxels and was
+        not clipped in place
+    n_clipped: int
+        number of negative voxels set to zero
+    """
+
+    import numpy as np
+
+    negative = img_data < 0
+    n_clipped = int(np.count_nonzero(negative))
+
+    if n_clipped:
+        if not (in_place and img_data.flags.writeable):
+            img_data = img_data.copy()
+        img_data[negative] = 0
+
+    return img_data, n_clipped
+
+
+
 def convert_negatives(img_data):
 
-    # convert any negative voxel values to zero, provide warning
-    for vox in img_data.flatten():
-        if vox < 0:
-            print "\nWARNING: Negative voxel values in anatomical scan " \
-                  "converted to zero.\n"
-            img_data = img_data.clip(0)
-            break
+    # convert any negative voxel values to zero
+    img_data, _ = clip_negatives(img_data)
 
     return img_data
 
@@ -187,7 +299,85 @@ def efc(anat_data):
 
 
 
-def artifacts(anat_data, fg_mask_data, calculate_qi2=False):
+def chi_goodness_of_fit(noise_data, max_bins=256):
+
+    """
+    Goodness of fit of a chi distribution to the background noise
+    histogram, the second term of QI2 (Mortamet et al. 2009).
+
+    The chi distribution is fit by maximum likelihood to the binned
+    histogram (at most max_bins bins) instead of to every noise voxel, so
+    the cost of the fit does not depend on the image size. The goodness of
+    fit is the mean absolute difference between the normalized histogram
+    and the fitted density over the right tail of the histogram (from the
+    first bin past the peak that is below half of the maximum), in units of
+    the noise standard deviation.
+
+    Parameters
+    ----------
+    noise_data: np.array
+        background noise intensities (non-negative)
+    max_bins: int
+        maximum number of histogram bins
+
+    Returns
+    -------
+    gof: float
+    """
+
+    import numpy as np
+    import scipy.optimize as so
+    import scipy.stats as ss
+
+    noise_std = noise_data.std() if noise_data.size else 0
+
+    if noise_std == 0:
+        return 0.0
+
+    # unit-width bins for integer data with a small range
+    noise_max = float(noise_data.max())
+    n_bins = int(min(max_bins, np.floor(noise_max) + 1))
+    edges = np.linspace(0, np.floor(noise_max) + 1, n_bins + 1)
+    counts, _ = np.histogram(noise_data, bins=edges)
+
+    # histogram density in units of the noise standard deviation
+    edges_z = edges / noise_std
+    centers_z = (edges_z[:-1] + edges_z[1:]) / 2
+    H = counts / (counts.sum() * np.diff(edges_z))
+
+    def neg_log_likelihood(params):
+        df, scale = np.exp(params)
+        prob = np.diff(ss.chi.cdf(edges_z, df, scale=scale))
+        return -(counts * np.log(np.maximum(prob, 1e-300))).sum()
+
+    # start from two degrees of freedom (Rayleigh), matching the second
+    # moment of the histogram
+    moment2 = (counts * centers_z ** 2).sum() / counts.sum()
+    init = np.log([2.0, np.sqrt(moment2 / 2.0)])
+    fit = so.minimize(neg_log_likelihood, init, method="Nelder-Mead")
+    df, scale = np.exp(fit.x)
+
+    # find the first value on the right tail, i.e. tail with negative
+    # slope, i.e. dH < 0 that is less than or equal to half of the
+    # histograms max
+    neg_slope = np.nonzero(np.diff(H) < 0)[0]
+    first_neg_slope = neg_slope[0] if neg_slope.size else 0
+    right_tail = np.nonzero(H[first_neg_slope:] < (H.max() / 2))[0]
+
+    if right_tail.size == 0:
+        return 0.0
+
+    tail_start = first_neg_slope + right_tail[0]
+
+    # now we can calculate the goodness of fit
+    fitted = ss.chi.pdf(centers_z, df, scale=scale)
+    gof = np.mean(np.abs(H[tail_start:] - fitted[tail_start:]))
+
+    return gof
+
+
+
+def artifacts(anat_data, fg_mask_data, calculate_qi2=False, crop=True):
 
     # Detect artifacts in the anatomical image using the method described in
     # Mortamet et al. 2009 (MRM)
@@ -197,22 +387,32 @@ def artifacts(anat_data, fg_mask_data, calculate_qi2=False):
     # of noise voxel (non-artifact background voxels) intensities, and a 
     # Ricean distribution.
 
+    # With crop, the opening only runs on the bounding box of the
+    # supra-threshold background voxels (padded by the radius of the
+    # structuring element), which gives the same QI1.
+
     import numpy as np
 
-    background, bg_mask = get_background(anat_data, fg_mask_data)
-    
-    # make sure the datatype is an int
-    background = check_datatype(background)
+    bg_mask = fg_mask_data == 0
+
+    # make sure the datatype is an int (only the background values are
+    # copied for this)
+    bg_data = check_datatype(anat_data[bg_mask])
        
     # Find the background threshold (the most frequently occurring value 
     # excluding 0)
-    bg_counts       = np.bincount(background.flatten())
+    bg_counts       = np.bincount(bg_data)
     bg_threshold    = np.argmax(bg_counts[1:]) + 1
+    del bg_data
 
     # Apply this threshold to the background voxels to identify voxels
-    # contributing artifacts. 
-    background[background <= bg_threshold] = 0
-    background[background != 0] = 1
+    # contributing artifacts. Floating point values are compared as their
+    # integer (truncated) values would be.
+    if np.issubdtype(anat_data.dtype, float):
+        background  = anat_data >= bg_threshold + 1
+    else:
+        background  = anat_data > bg_threshold
+    background     &= bg_mask
 
     # Create a structural element to be used in an opening operation.
     struct_elmnt    = np.zeros((3,3,3))
@@ -221,6 +421,22 @@ def artifacts(anat_data, fg_mask_data, calculate_qi2=False):
     struct_elmnt[1,:,1] = 1
     struct_elmnt[2,1,1] = 1
 
+    bbox = None
+    if crop:
+        # Outside of the bounding box the background is all zero, so
+        # nothing changes there.
+        box = []
+        for axis in range(background.ndim):
+            other_axes = tuple(ax for ax in range(background.ndim)
+                               if ax != axis)
+            idx = np.nonzero(background.any(axis=other_axes))[0]
+            if idx.size == 0:
+                break
+            box.append(slice(max(idx[0] - 1, 0), idx[-1] + 2))
+        else:
+            bbox = tuple(box)
+            background = background[bbox]
+
     # Perform an opening operation on the background data.
     background      = nd.binary_opening(background, structure=struct_elmnt)
 
@@ -228,36 +444,20 @@ def artifacts(anat_data, fg_mask_data, calculate_qi2=False):
     # These are artifacts.
     QI1             = background.sum() / float(bg_mask.sum())
     
-    ''' "bg" in code below not defined- need to ascertain what that should '''
-    '''      be, and correct it- unit test for this part disabled for now  '''
     if calculate_qi2:
         # Now lets focus on the noise, which is everything in the background
         # that was not identified as artifact
-        bgNoise     = anat_data[(fg_mask_data-bg)==1]
-
-        # calculate the histogram of the noise and its derivative
-        H           = np.bincount(bgNoise)
-        H           = 1.0*H/H.sum()
-        dH          = H[1:]-H[:-1]
-
-        # find the first value on the right tail, i.e. tail with negative
-        # slope, i.e. dH < 0 that is less than or equal to half of the
-        # histograms max
-        firstNegSlope = np.nonzero(dH<0)[0][0]
-        halfMaxRightTail = np.nonzero(H[firstNegSlope:]<(H.max()/2))[0][0]
-
-        # divide by the standard deviation
-        bgNoiseZ    = bgNoise / bgNoise.std()
-        bgChiParams = ss.chi.fit(bgNoiseZ)
-        #print bgChiParams
-    
-        # now generate values that are consistent with the histogram
-        yx          = range(0,H.size)/bgNoise.std()
-        rvs         = ss.chi.pdf(yx,bgChiParams[0],loc=bgChiParams[1],scale=bgChiParams[2])
-
-        # now we can calculate the goodness of fit
-        gof         = np.average(np.absolute(H[halfMaxRightTail:]-rvs[halfMaxRightTail:]))
-        QI2         = QI1+gof
+        noise_mask  = bg_mask.copy()
+        if bbox is not None:
+            noise_mask[bbox] &= ~background
+        else:
+            noise_mask &= ~background
+
+        # zero-filled voxels (e.g. from resampling) are not noise
+        bg_noise    = check_datatype(anat_data[noise_mask])
+        bg_noise    = bg_noise[bg_noise > 0]
+
+        QI2         = QI1 + chi_goodness_of_fit(bg_noise)
     else:
         QI2         = None
 
@@ -313,6 +513,195 @@ def fwhm(anat_file, mask_file, out_vox=False):
 
 
 
+def calc_fwhm(img_data, mask_data, pixdim, out_vox=False):
+
+    """
+    Estimate the FWHM of an already loaded image, without calling AFNI.
+    
+    This follows the classic first-difference estimator of 3dFWHMx: for
+    each axis, the variance of the differences between neighbouring voxels
+    that are both inside the mask is compared to the variance of the data
+    in the mask, assuming a Gaussian spatial autocorrelation.
+    
+    Parameters
+    ----------
+    img_data: np.array
+        3D image data
+    mask_data: np.array
+        brain mask
+    pixdim: sequence
+        voxel dimensions (mm) along x, y and z
+    out_vox: bool
+        output the FWHM as # of voxels (otherwise as mm)
+    
+    Returns
+    -------
+    fwhm: tuple (x,y,z,combined)
+        FWHM in the x, y, x, and combined direction; -1 in a direction
+        where it could not be estimated
+    """
+
+    import numpy as np
+    from scipy.special import cbrt
+
+    mask = mask_data > 0
+    pixdim = np.abs(np.asarray(pixdim[:3], dtype=np.float64))
+
+    # differences are taken in floating point, as AFNI does (this also
+    # keeps unsigned data from wrapping around)
+    if not np.issubdtype(img_data.dtype, np.floating):
+        img_data = img_data.astype(np.float32)
+
+    var = img_data[mask].astype(np.float64).var(ddof=1)
+
+    vals = []
+
+    for axis in range(3):
+
+        # neighbouring voxel pairs along this axis, both inside the mask
+        lower = [slice(None)] * 3
+        upper = [slice(None)] * 3
+        lower[axis] = slice(None, -1)
+        upper[axis] = slice(1, None)
+        pairs = mask[tuple(lower)] & mask[tuple(upper)]
+
+        diffs = np.diff(img_data, axis=axis)[pairs].astype(np.float64)
+
+        if diffs.size < 6 or var <= 0:
+            vals.append(-1.0)
+            continue
+
+        arg = 1.0 - 0.5 * (diffs.var(ddof=1) / var)
+
+        if arg <= 0.0 or arg >= 1.0:
+            vals.append(-1.0)
+            continue
+
+        # FWHM = sqrt(8 ln 2) * sigma
+        sigma = np.sqrt(-1.0 / (4.0 * np.log(arg))) * pixdim[axis]
+        vals.append(2.35482 * sigma)
+
+    vals = np.array(vals)
+
+    # combined: the geometric mean of the three directions
+    if (vals > 0).all():
+        vals = np.append(vals, cbrt(vals.prod()))
+    else:
+        vals = np.append(vals, -1.0)
+
+    if out_vox:
+        # convert to voxels, leaving failed estimates at -1
+        pixdim  = np.append(pixdim, cbrt(pixdim.prod()))
+        vals    = np.where(vals > 0, vals / pixdim, vals)
+
+    return tuple(vals)
+
+
+
+def ghost_directions(epi_data, mask_data, directions=("x", "y", "z"),
+                     ref_file=None, out_file=None):
+
+    """
+    Ghost to Signal Ratio in one or more phase encoding directions
+    Giannelli 2010 -
+        http://www.jacmp.org/index.php/jacmp/article/view/3237/2035
+
+    The Nyquist ghost mask of each direction is the brain mask circularly
+    shifted by N/2 along that axis (with np.roll), minus the brain mask.
+    The signal and background sums are shared by all directions, so only
+    the ghost region is summed per direction.
+
+    Parameters
+    ----------
+    epi_data: np.array
+        (mean) EPI image data
+    mask_data: np.array
+        binary brain mask
+    directions: sequence of str
+        the directions of phase encoding (x, y, z) to measure
+    ref_file: str
+        path to the image whose header is used when writing the masks
+    out_file: str
+        path to write the masks to (0 signal, 1 ghost, 2 non-ghost
+        background), one volume per direction
+
+    Returns
+    -------
+    gsrs: list
+        ghost to signal ratio for each of the directions
+    """
+
+    import numpy as np
+
+    axes = {"x": 0, "y": 1, "z": 2}
+
+    for direction in directions:
+        if direction not in axes:
+            raise Exception("Unknown direction %s, should be x, y, or z" \
+                            % direction)
+
+    mask = mask_data != 0
+    background = ~mask
+
+    # here we define signal as the entire foreground image
+    signal_mean = epi_data[mask].mean(dtype=np.float64)
+
+    bg_sum = epi_data[background].sum(dtype=np.float64)
+    bg_size = np.count_nonzero(background)
+
+    gsrs = []
+    ghost_masks = []
+
+    for direction in directions:
+
+        axis = axes[direction]
+
+        # first we need to make a nyquist ghost mask, we do this by circle
+        # shifting the original mask by N/2 and then removing the
+        # intersection with the original mask (for an odd N, the last
+        # slice is left out of the shift)
+        n2 = mask.shape[axis] // 2
+        even_part = [slice(None)] * mask.ndim
+        even_part[axis] = slice(0, 2 * n2)
+        even_part = tuple(even_part)
+
+        ghost = np.zeros_like(mask)
+        ghost[even_part] = np.roll(mask[even_part], n2, axis=axis)
+        ghost &= background
+
+        ghost_sum = epi_data[ghost].sum(dtype=np.float64)
+        ghost_size = np.count_nonzero(ghost)
+
+        # the non-ghost background is the rest of the background
+        ghost_mean = ghost_sum / ghost_size
+        nonghost_mean = (bg_sum - ghost_sum) / (bg_size - ghost_size)
+
+        gsrs.append((ghost_mean - nonghost_mean) / signal_mean)
+
+        if out_file is not None:
+            ghost_masks.append(ghost)
+
+    # Save masks
+    if ref_file is not None and out_file is not None:
+        import nibabel as nib
+
+        labels = [ghost + 2 * ~(ghost | mask) for ghost in ghost_masks]
+        if len(labels) == 1:
+            labels = labels[0]
+        else:
+            labels = np.stack(labels, axis=-1)
+
+        ref = nib.load(ref_file)
+        header = ref.get_header().copy()
+        header.set_data_dtype(np.uint8)
+        out = nib.Nifti1Image(labels.astype(np.uint8), ref.get_affine(),
+                              header)
+        out.to_filename(out_file)
+
+    return gsrs
+
+
+
 def ghost_direction(epi_data, mask_data, direction="y", ref_file=None,
                     out_file=None):
 
@@ -338,49 +727,10 @@ def ghost_direction(epi_data, mask_data, direction="y", ref_file=None,
     gsr: float
         ghost to signal ratio
     """
-    
-    import numpy as np
-    
-    # first we need to make a nyquist ghost mask, we do this by circle 
-    # shifting the original mask by N/2 and then removing the intersection
-    # with the original mask
-    n2_mask_data    = np.zeros_like(mask_data)
-    
-    ## rotate by n/2
-    if direction == "x":
-        n2                      = np.floor(mask_data.shape[0]/2)
-        n2_mask_data[:n2,:,:]   = mask_data[n2:(n2*2),:,:]
-        n2_mask_data[n2:(n2*2),:,:]   = mask_data[:n2,:,:]
-    elif direction == "y":
-        n2                      = np.floor(mask_data.shape[1]/2)
-        n2_mask_data[:,:n2,:]   = mask_data[:,n2:(n2*2),:]
-        n2_mask_data[:,n2:(n2*2),:]   = mask_data[:,:n2,:]
-    elif direction == "z":
-        n2                      = np.floor(mask_data.shape[2]/2)
-        n2_mask_data[:,:,:n2]   = mask_data[:,:,n2:(n2*2)]
-        n2_mask_data[:,:,n2:(n2*2)]   = mask_data[:,:,:n2]        
-    else:
-        raise Exception("Unknown direction %s, should be x, y, or z" \
-                        % direction)
-    
-    ## now remove the intersection with the original mask
-    n2_mask_data    = n2_mask_data * (1-mask_data)
-    
-    ## now create a non-ghost background region, that contains 2s
-    n2_mask_data    = n2_mask_data + 2*(1-n2_mask_data-mask_data)
-    
-    # Save mask
-    if ref_file is not None and out_file is not None:
-        import nibabel as nib
-        ref = nib.load(ref_file)
-        out = nib.Nifti1Image(n2_mask_data, ref.get_affine(), ref.get_header()) 
-        out.to_filename(out_file)
-   
-    # now we calculate the Ghost to signal ratio, but here we define signal
-    # as the entire foreground image
-    gsr             = (epi_data[n2_mask_data==1].mean() - epi_data[n2_mask_data==2].mean())/epi_data[n2_mask_data==0].mean()
 
-    
+    gsr = ghost_directions(epi_data, mask_data, [direction],
+                           ref_file=ref_file, out_file=out_file)[0]
+
     return gsr
 
 
@@ -392,7 +742,7 @@ def ghost_all(epi_data, mask_data):
     Giannelli 2010 -
         http://www.jacmp.org/index.php/jacmp/article/view/3237/2035
     
-    This calls on `ghost_direction` to measure GSR in all possible phase
+    This calls on `ghost_directions` to measure GSR in all possible phase
     encoding directions.
     
     Parameters
@@ -409,8 +759,6 @@ def ghost_all(epi_data, mask_data):
     """
     
     directions = ["x", "y"]
-    gsrs = [ ghost_direction(epi_data, mask_data, d) for d in directions ]
+    gsrs = ghost_directions(epi_data, mask_data, directions)
     
     return tuple(gsrs + [None])
-
-
@@ -30,7 +30,8 @@ def fd_jenkinson(in_file, rmax=80., out_file=None):
     Parameters; in_file : string
                 rmax : float
                 The default radius (as in FSL) of a sphere represents the brain
-    Returns; out_file : string
+    Returns; out_file : string (a binary .npy copy of the FD time series
+             is saved next to it, see load_fd)
     NOTE: infile should have one 3dvolreg affine matrix in one row -
     NOT the motion parameters
     '''
@@ -40,7 +41,8 @@ def fd_jenkinson(in_file, rmax=80., out_file=None):
     import os.path as op
     from shutil import copyfile
     import sys
-    import math
+
+    from qap.temporal_qc import fd_sidecar
 
     if out_file is None:
         fname, ext = op.splitext(op.basename(in_file))
@@ -50,40 +52,68 @@ def fd_jenkinson(in_file, rmax=80., out_file=None):
     # of the MCFLIRT command, forward that file
     if 'rel.rms' in in_file:
         copyfile(in_file, out_file)
+        np.save(fd_sidecar(out_file), np.loadtxt(out_file))
         return out_file
 
-    pm_ = np.genfromtxt(in_file)
-    original_shape = pm_.shape
-    pm = np.zeros((pm_.shape[0], pm_.shape[1] + 4))
-    pm[:, :original_shape[1]] = pm_
-    pm[:, original_shape[1]:] = [0.0, 0.0, 0.0, 1.0]
-
-    # rigid body transformation matrix
-    T_rb_prev = np.matrix(np.eye(4))
+    # one 3dvolreg affine matrix per row, stored "row-by-row"; stack them
+    # into an N x 4 x 4 array of rigid body transformation matrices
+    pm = np.atleast_2d(np.genfromtxt(in_file))
+    T_rb = np.zeros((pm.shape[0], 4, 4))
+    T_rb[:, :3, :] = pm[:, :12].reshape(-1, 3, 4)
+    T_rb[:, 3, 3] = 1.0
 
-    flag = 0
-    X = [0]  # First timepoint
-    for i in range(0, pm.shape[0]):
-        # making use of the fact that the order of aff12 matrix is "row-by-row"
-        T_rb = np.matrix(pm[i].reshape(4, 4))
+    # relative transformation between consecutive frames
+    M = np.einsum('nij,njk->nik', T_rb[1:], np.linalg.inv(T_rb[:-1])) - \
+        np.eye(4)
+    A = M[:, 0:3, 0:3]
+    b = M[:, 0:3, 3]
 
-        if flag == 0:
-            flag = 1
-        else:
-            M = np.dot(T_rb, T_rb_prev.I) - np.eye(4)
-            A = M[0:3, 0:3]
-            b = M[0:3, 3]
+    FD_J = np.sqrt((rmax * rmax / 5) * np.einsum('nij,nij->n', A, A) +
+                   np.einsum('ni,ni->n', b, b))
 
-            FD_J = math.sqrt(
-                (rmax * rmax / 5) * np.trace(np.dot(A.T, A)) + np.dot(b.T, b))
-            X.append(FD_J)
+    # First timepoint
+    X = np.concatenate(([0], FD_J))
 
-        T_rb_prev = T_rb
+    np.savetxt(out_file, X)
+    np.save(fd_sidecar(out_file), X)
 
-    np.savetxt(out_file, np.array(X))
     return out_file
 
 
+def fd_sidecar(fd_file):
+    """
+    Path of the binary (.npy) copy of a framewise displacement file, written
+    next to it by fd_jenkinson.
+    """
+
+    return os.path.splitext(fd_file)[0] + ".npy"
+
+
+def load_fd(fd_file):
+    """
+    Load a framewise displacement time series, from its binary sidecar
+    when there is an up-to-date one, otherwise by parsing the text file.
+
+    Parameters
+    ----------
+    fd_file: str
+        Path to the FD file written by fd_jenkinson (or a forwarded MCFLIRT
+        rel.rms file)
+
+    Returns
+    -------
+    fd: np.array
+    """
+
+    sidecar = fd_sidecar(fd_file)
+
+    if os.path.isfile(sidecar) and \
+            os.path.getmtime(sidecar) >= os.path.getmtime(fd_file):
+        return np.load(sidecar)
+
+    return np.loadtxt(fd_file)
+
+
 # 3dTout
 def outlier_timepoints(func_file, mask_file, out_fraction=True):
     """
@@ -132,6 +162,71 @@ def outlier_timepoints(func_file, mask_file, out_fraction=True):
     return outliers
 
 
+def calc_outlier_timepoints(func, out_fraction=True, polort=0, qthr=0.001,
+                            chunk_size=10000):
+    """
+    In-process equivalent of 3dToutcount, run on an already masked time
+    series matrix.
+
+    Each voxel time series is detrended (with polort=0 only the median is
+    removed, as in the 3dToutcount default), and a time point is an outlier
+    when its absolute deviation exceeds alpha * sqrt(pi/2) * MAD, with
+    alpha = qginv(qthr / ntpts). Voxels with a MAD of zero have no spread to
+    judge against and are not counted.
+
+    Parameters
+    ----------
+    func: np.array
+        ntpts x nvoxs matrix of the masked functional time series
+    out_fraction: bool (default: True)
+        Whether the output should be a count (False) or fraction (True)
+        of the number of masked voxels which are outliers at each time point.
+    polort: int (default: 0)
+        Order of the Legendre polynomial trend removed before the median.
+        Unlike 3dToutcount, which uses an L1 fit, the trend is a least
+        squares fit.
+    qthr: float (default: 0.001)
+        Tail probability used for the outlier threshold (3dToutcount -qthr)
+    chunk_size: int
+        Number of voxels processed at a time
+
+    Returns
+    -------
+    outliers: np.array
+    """
+
+    ntpts, nvoxs = func.shape
+
+    alpha = stats.norm.isf(qthr / ntpts) * np.sqrt(np.pi / 2)
+
+    if polort > 0:
+        # project out the Legendre trend with one pseudo-inverse, shared by
+        # all voxels
+        legendre = np.polynomial.legendre.legvander(
+            np.linspace(-1, 1, ntpts), polort)
+        detrend = np.eye(ntpts) - legendre.dot(np.linalg.pinv(legendre))
+
+    counts = np.zeros(ntpts)
+
+    for start in range(0, nvoxs, chunk_size):
+
+        chunk = func[:, start:start + chunk_size]
+
+        if polort > 0:
+            chunk = detrend.dot(chunk)
+
+        deviation = np.abs(chunk - np.median(chunk, 0))
+        mad = np.median(deviation, 0)
+
+        outlier = (deviation > alpha * mad) & (mad > 0)
+        counts += outlier.sum(1)
+
+    if out_fraction:
+        return counts / nvoxs
+
+    return counts
+
+
 def mean_outlier_timepoints(*args, **kwrds):
     outliers = outlier_timepoints(*args, **kwrds)
     mean_outliers = np.mean(outliers)
@@ -174,45 +269,372 @@ def quality_timepoints(func_file, automask=True):
     return outliers
 
 
+def calc_quality_timepoints(func, chunk_size=10000):
+    """
+    In-process equivalent of 3dTqual, run on an already masked time series
+    matrix.
+
+    The quality index of each time point is one minus the Spearman
+    correlation of that volume with the median volume, over the voxels of
+    the given (functional brain) mask rather than a recomputed automask.
+    Low values are good and indicate that the timepoint is not very
+    different from the norm.
+
+    Parameters
+    ----------
+    func: np.array
+        ntpts x nvoxs matrix of the masked functional time series
+    chunk_size: int
+        Number of voxels processed at a time for the median volume; the
+        rank transform works on blocks of volumes of about 100 times that
+        many values
+
+    Returns
+    -------
+    qualities: np.array
+    """
+
+    ntpts, nvoxs = func.shape
+
+    median_vol = np.empty(nvoxs)
+    for start in range(0, nvoxs, chunk_size):
+        median_vol[start:start + chunk_size] = \
+            np.median(func[:, start:start + chunk_size], 0)
+
+    median_rank = _centered_rank(median_vol)
+
+    qualities = np.empty(ntpts)
+    tpts_per_chunk = max(1, (100 * chunk_size) // max(1, nvoxs))
+
+    for start in range(0, ntpts, tpts_per_chunk):
+        qualities[start:start + tpts_per_chunk] = _rank_quality(
+            func[start:start + tpts_per_chunk], median_rank)
+
+    return qualities
+
+
+def _centered_rank(median_vol):
+    """
+    Ranks of the median volume, centered and scaled to unit norm.
+    """
+
+    median_rank = stats.rankdata(median_vol)
+    median_rank -= median_rank.mean()
+    median_rank /= np.sqrt((median_rank ** 2).sum())
+
+    return median_rank
+
+
+def _rank_quality(vols, median_rank):
+    """
+    Quality index (one minus the Spearman correlation with the median
+    volume) of each row of `vols`, a block of masked volumes.
+    """
+
+    # Spearman correlation is the Pearson correlation of the ranks
+    ranks = np.array([stats.rankdata(vol) for vol in vols])
+    ranks -= ranks.mean(1)[:, np.newaxis]
+
+    corr = ranks.dot(median_rank) / np.sqrt((ranks ** 2).sum(1))
+
+    return 1 - corr
+
+
 def mean_quality_timepoints(*args, **kwrds):
     qualities = quality_timepoints(*args, **kwrds)
     mean_qualities = np.mean(qualities)
     return mean_qualities
 
 
-def global_correlation(func_motion, func_mask):
+def calc_global_correlation(func, chunk_size=10000):
+    """
+    Calculate the global correlation (GCOR) of a time series matrix.
+
+    Every voxel time series is z-scored (population standard deviation, as
+    scipy.stats.mstats.zscore) and the z-scores are summed into the average
+    time series one block of voxels at a time, so only a chunk_size-wide
+    temporary is ever created on top of func.
+
+    Parameters
+    ----------
+    func: np.array
+        ntpts x nvoxs matrix of the masked functional time series (e.g. the
+        one already loaded for DVARS)
+    chunk_size: int
+        number of voxels z-scored at once
+
+    Returns
+    -------
+    gcor: float
+    """
+
+    import numpy as np
+
+    ntpts, nvoxs = func.shape
+
+    # average of the z-scored time series, a vector of N volumes
+    avg_ts = np.zeros(ntpts)
+
+    for start in range(0, nvoxs, chunk_size):
+        avg_ts += _zscore_sum(func[:, start:start + chunk_size])
+
+    return _gcor(avg_ts / nvoxs)
+
+
+def _zscore_sum(chunk):
+    """
+    Sum of the z-scored time series of a block of voxels.
+    """
 
-    import scipy
     import numpy as np
+
+    chunk = np.asarray(chunk, dtype=np.float64)
+    chunk = chunk - chunk.mean(0)
+    sd = chunk.std(0)
+    # constant voxels z-score to zero, as the masked zscore leaves them
+    sd[sd == 0] = np.inf
+    chunk /= sd
+
+    return chunk.sum(1)
+
+
+def _gcor(avg_ts):
+    # calculate the global correlation from the average z-scored series
+    return avg_ts.dot(avg_ts) / len(avg_ts)
+
+
+def global_correlation(func_motion, func_mask):
+
     from dvars import load
 
     zero_variance_func = load(func_motion, func_mask)
 
-    list_of_ts = zero_variance_func.transpose()
+    return calc_global_correlation(zero_variance_func)
+
+
+def _mean_var(func, chunk_size=10000):
+    """
+    Temporal mean and variance of every column of an ntpts x nvoxs matrix,
+    computed in blocks of voxels so no full-size temporary is created.
+    """
+
+    mean = np.empty(func.shape[1])
+    var = np.empty(func.shape[1])
+
+    for start in range(0, func.shape[1], chunk_size):
+        chunk = func[:, start:start + chunk_size]
+        mean[start:start + chunk_size] = chunk.mean(0)
+        var[start:start + chunk_size] = chunk.var(0)
+
+    return mean, var
+
+
+def temporal_metrics(func_file, mask_file, dvars_out_file=None,
+                     outliers=True, quality=True, dvars_block_size=None,
+                     dvars=True, gcor=True):
+    """
+    Calculate the voxelwise temporal measures from a single load of the
+    functional time series.
+
+    The 4D file is decompressed and masked once, and DVARS, GCOR, the
+    median tSNR, the mean outlier fraction and the mean quality index are
+    all computed from that one ntpts x nvoxs buffer. With a block size, the
+    file is memory-mapped instead and the measures are accumulated one
+    block of voxels at a time (see `_temporal_metrics_blocks`), so the
+    time series is never held whole.
+
+    Parameters
+    ----------
+    func_file: str
+        Path to 4D functional file
+    mask_file: str
+        Path to functional brain mask
+    dvars_out_file: str (optional)
+        Path to write the DVARS time series to
+    outliers: bool (default: True)
+        Whether to compute the outlier fraction in-process (set to False
+        when 3dToutcount is used instead)
+    quality: bool (default: True)
+        Whether to compute the quality index in-process (set to False when
+        3dTqual is used instead)
+    dvars_block_size: int (optional)
+        Number of voxels read and processed at a time, bounding the memory
+        used for the time series and its temporary copies (default: the
+        whole mask at once)
+    dvars: bool (default: True)
+        Whether to compute DVARS
+    gcor: bool (default: True)
+        Whether to compute the global correlation
+
+    Returns
+    -------
+    metrics: dict
+        median tSNR inside the mask ('m_tsnr') and, if requested, mean
+        DVARS ('dvars'), global correlation ('gcor'), the mean outlier
+        fraction ('outlier') and mean quality index ('quality')
+    """
+
+    from dvars import calc_dvars, calc_mean_dvars
+
+    if dvars_block_size:
+        return _temporal_metrics_blocks(func_file, mask_file, dvars_out_file,
+                                        outliers, quality, dvars_block_size,
+                                        dvars, gcor)
+
+    func_data = nb.load(func_file).get_data()
+    mask_data = nb.load(mask_file).get_data()
+
+    if len(func_data.shape) != 4:
+        raise Exception("Input functional %s should be 4-dimensional" \
+                        % func_file)
+
+    # the only full copy of the data: every masked voxel, ntpts x nvoxs
+    func = func_data[mask_data.nonzero()].astype(np.float64).T
+    del func_data
+
+    func_mean, func_var = _mean_var(func)
+
+    # tSNR over the whole mask, with the same rule as nipype's TSNR for
+    # voxels without signal fluctuation
+    func_std = np.sqrt(func_var)
+    tsnr = np.zeros_like(func_mean)
+    nonzero_std = func_std > 1.e-3
+    tsnr[nonzero_std] = func_mean[nonzero_std] / func_std[nonzero_std]
+
+    # 3dToutcount and 3dTqual work on every voxel of the mask
+    if outliers:
+        mean_outlier = np.mean(calc_outlier_timepoints(func))
+
+    if quality:
+        mean_quality = np.mean(calc_quality_timepoints(func))
+
+    metrics = {"m_tsnr": np.median(tsnr)}
+
+    # DVARS and GCOR drop the zero-variance voxels, as dvars.load does
+    nonzero_var = func_var >= 1
+    if (dvars or gcor) and not nonzero_var.all():
+        func = func[:, nonzero_var]
+
+    if dvars:
+        dvars_ts = calc_dvars(func)
+        if dvars_out_file:
+            np.savetxt(dvars_out_file, dvars_ts, fmt='%.12f')
+        metrics["dvars"] = calc_mean_dvars(dvars_ts)[0]
+
+    if gcor:
+        metrics["gcor"] = calc_global_correlation(func)
+
+    if outliers:
+        metrics["outlier"] = mean_outlier
 
-    # get array of z-scored values of each voxel in each volume of the
-    # timeseries
-    demeaned_normed = []
+    if quality:
+        metrics["quality"] = mean_quality
+
+    return metrics
+
+
+def _temporal_metrics_blocks(func_file, mask_file, dvars_out_file,
+                             outliers, quality, block_size, dvars, gcor):
+    """
+    Block-wise version of `temporal_metrics`.
+
+    The functional is memory-mapped and read one block of voxels at a time
+    (`dvars.iter_masked_blocks`), and every measure is accumulated from
+    the blocks: the tSNR and median of each voxel, the outlier counts of
+    each time point, the sum of the z-scored series for GCOR and the
+    moments DVARS needs. The quality index, which ranks whole volumes, is
+    then computed from one volume at a time. At most one block of the time
+    series is in memory, plus a few values per voxel.
+    """
+
+    from dvars import iter_masked_blocks, calc_dvars_blocks, \
+        calc_mean_dvars, uncompressed_image, masked_slabs
+
+    tmp_dir = mkdtemp()
+
+    try:
+        # decompress once, for the blocks and the volumes
+        nii_file = uncompressed_image(func_file, tmp_dir)
+
+        # per-voxel values, and the sums accumulated over the blocks
+        tsnr = []
+        median_vol = []
+        acc = {"counts": 0., "avg_ts": 0., "n_mask": 0, "n_signal": 0}
+
+        def _blocks():
+            for block in iter_masked_blocks(nii_file, mask_file, block_size,
+                                            drop_constant=False):
+                func_mean, func_var = block.mean(0), block.var(0)
+
+                # tSNR, with the same rule as nipype's TSNR
+                func_std = np.sqrt(func_var)
+                block_tsnr = np.zeros_like(func_mean)
+                nonzero_std = func_std > 1.e-3
+                block_tsnr[nonzero_std] = \
+                    func_mean[nonzero_std] / func_std[nonzero_std]
+                tsnr.append(block_tsnr)
+
+                # 3dToutcount and 3dTqual work on every voxel of the mask
+                if outliers:
+                    acc["counts"] = acc["counts"] + calc_outlier_timepoints(
+                        block, out_fraction=False)
+
+                if quality:
+                    median_vol.append(np.median(block, 0))
+
+                acc["n_mask"] += block.shape[1]
+
+                # DVARS and GCOR drop the zero-variance voxels
+                block = block[:, func_var >= 1]
+
+                if gcor:
+                    acc["avg_ts"] = acc["avg_ts"] + _zscore_sum(block)
+
+                acc["n_signal"] += block.shape[1]
+
+                yield block
+
+        if dvars:
+            dvars_ts = calc_dvars_blocks(_blocks())
+        else:
+            for block in _blocks():
+                pass
 
-    for ts in list_of_ts:
+        if acc["n_mask"] == 0:
+            raise Exception("The mask %s is empty" % mask_file)
 
-        demeaned_normed.append(scipy.stats.mstats.zscore(ts))
+        metrics = {"m_tsnr": np.median(np.concatenate(tsnr))}
 
-    demeaned_normed = np.asarray(demeaned_normed)
+        if dvars:
+            if dvars_out_file:
+                np.savetxt(dvars_out_file, dvars_ts, fmt='%.12f')
+            metrics["dvars"] = calc_mean_dvars(dvars_ts)[0]
 
-    # make an average of the normalized timeseries, into one averaged
-    # timeseries, a vector of N volumes
-    volume_list = demeaned_normed.transpose()
+        if gcor:
+            metrics["gcor"] = _gcor(acc["avg_ts"] / acc["n_signal"])
 
-    avg_ts = []
+        if outliers:
+            metrics["outlier"] = np.mean(acc["counts"] / acc["n_mask"])
 
-    for voxel in volume_list:
+        if quality:
+            # the volumes are masked slab by slab, in the order of the
+            # blocks the median volume was built from
+            func_img = nb.load(nii_file, mmap=True)
+            mask = nb.load(mask_file).get_data() != 0
+            slabs = masked_slabs(mask, block_size)
+            median_rank = _centered_rank(np.concatenate(median_vol))
 
-        avg_ts.append(voxel.mean())
+            qualities = []
+            for t in range(func_img.shape[3]):
+                vol = np.asanyarray(func_img.dataobj[..., t])
+                vol = np.concatenate([vol[:, :, z0:z1][mask[:, :, z0:z1]]
+                                      for z0, z1 in slabs])
+                qualities.append(_rank_quality(vol[np.newaxis, :],
+                                               median_rank)[0])
 
-    avg_ts = np.asarray(avg_ts)
+            metrics["quality"] = np.mean(qualities)
 
-    # calculate the global correlation
-    gcor = (avg_ts.transpose().dot(avg_ts)) / len(avg_ts)
+        return metrics
 
-    return gcor
+    finally:
+        shutil.rmtree(tmp_dir)
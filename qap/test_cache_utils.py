@@ -0,0 +1,153 @@
+
+
+def test_input_digests():
+
+    import os
+    import shutil
+    import tempfile
+
+    from qap.cache_utils import input_digests, file_digest
+
+    tmp_dir = tempfile.mkdtemp()
+    scan = os.path.join(tmp_dir, "anat.nii.gz")
+
+    try:
+        with open(scan, "wb") as f:
+            f.write(b"first scan")
+
+        manifest = {"inputs": {}, "stages": {}}
+        resource_pool = {"anatomical_scan": scan,
+                         "anatomical_reorient": ("node", "out_file")}
+
+        digests = input_digests(resource_pool, manifest)
+
+        # only the files are digested, and the digest is recorded
+        assert list(digests.keys()) == ["anatomical_scan"]
+        assert digests["anatomical_scan"] == file_digest(scan)
+        assert manifest["inputs"][os.path.abspath(scan)][2] == \
+            file_digest(scan)
+
+        # replacing the scan changes its digest
+        with open(scan, "wb") as f:
+            f.write(b"second, longer scan")
+
+        assert input_digests(resource_pool, manifest) != digests
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+
+def test_stage_key():
+
+    from qap.cache_utils import stage_key
+
+    digests = {"anatomical_scan": "0" * 40}
+    config = {"fwhm_method": "native", "num_cores_per_subject": 1,
+              "output_directory": "/tmp/a"}
+
+    key = stage_key("qap_anatomical_spatial", digests, config)
+
+    # settings that do not change the results keep the key
+    config.update({"num_cores_per_subject": 4,
+                   "output_directory": "/tmp/b"})
+    assert stage_key("qap_anatomical_spatial", digests, config) == key
+
+    # the settings of the stage and the inputs change it
+    assert stage_key("qap_anatomical_spatial", digests,
+                     dict(config, fwhm_method="afni")) != key
+    assert stage_key("qap_anatomical_spatial",
+                     {"anatomical_scan": "1" * 40}, config) != key
+
+    # settings of other stages do not
+    assert stage_key("qap_anatomical_spatial", digests,
+                     dict(config, ghost_direction="x")) == key
+    assert stage_key("anatomical_reorient", digests,
+                     dict(config, fwhm_method="afni")) == \
+        stage_key("anatomical_reorient", digests, config)
+
+
+
+def test_reuse_outputs_in_sequence():
+
+    import copy
+    import os
+    import shutil
+    import tempfile
+
+    from qap.cache_utils import input_digests, stage_key, \
+        resolve_defaults, reuse_outputs
+
+    tmp_dir = tempfile.mkdtemp()
+
+    def run_scan(scan_id, config):
+        # the keying steps of cli._run_workflow, around a workflow builder
+        # that fills in a default and writes the spatial measures
+        output_dir = os.path.join(tmp_dir, scan_id)
+        scan = os.path.join(tmp_dir, scan_id + ".nii.gz")
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+            with open(scan, "wb") as f:
+                f.write(scan_id.encode("utf-8"))
+
+        manifest = manifest_of[scan_id]
+        digests = input_digests({"functional_scan": scan}, manifest)
+        settings = resolve_defaults(config)
+
+        reused, removed = reuse_outputs(output_dir, manifest, digests,
+                                        settings)
+
+        if "qap_functional_spatial" not in reused:
+            config.setdefault("ghost_direction", "y")
+            os.makedirs(os.path.join(output_dir, "qap_functional_spatial"))
+            with open(os.path.join(output_dir, "qap_functional_spatial",
+                                   "qap.csv"), "w") as f:
+                f.write("snr\n")
+            manifest["stages"]["qap_functional_spatial"] = \
+                stage_key("qap_functional_spatial", digests, settings)
+
+        return reused, removed
+
+    try:
+        manifest_of = {"scan_1": {"inputs": {}, "stages": {}},
+                       "scan_2": {"inputs": {}, "stages": {}}}
+        config = {"fwhm_method": "native", "start_idx": 0,
+                  "stop_idx": None, "slice_timing_correction": False}
+
+        # the scans each get a copy of the config, so the second one is
+        # keyed as the first was
+        for scan_id in ["scan_1", "scan_2"]:
+            assert run_scan(scan_id, copy.deepcopy(config)) == ({}, [])
+
+        # giving the default the builder filled in keeps both outputs
+        for scan_id in ["scan_1", "scan_2"]:
+            reused, removed = run_scan(scan_id, dict(config,
+                                                     ghost_direction="y"))
+            assert list(reused.keys()) == ["qap_functional_spatial"]
+            assert removed == []
+
+        # an output whose file is gone is recomputed, even with its key
+        os.remove(os.path.join(tmp_dir, "scan_1", "qap_functional_spatial",
+                               "qap.csv"))
+        reused, removed = run_scan("scan_1", dict(config,
+                                                  ghost_direction="y"))
+        assert reused == {}
+        assert removed == ["qap_functional_spatial"]
+
+        # changing it recomputes them
+        for scan_id in ["scan_1", "scan_2"]:
+            reused, removed = run_scan(scan_id, dict(config,
+                                                     ghost_direction="x"))
+            assert reused == {}
+            assert removed == ["qap_functional_spatial"]
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+
+def run_all_tests_cache_utils():
+
+    test_input_digests()
+    test_stage_key()
+    test_reuse_outputs_in_sequence()
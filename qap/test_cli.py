@@ -0,0 +1,368 @@
+
+
+def test_admit():
+
+    from qap.cli import _admit
+
+    gb = 1024**3
+    pending = [(2 * gb, "small"), (8 * gb, "large"), (6 * gb, "mid"),
+               (3 * gb, "smaller")]
+
+    # the largest subject is admitted first, and the smaller ones fill
+    # what is left of the budget
+    admitted = _admit(pending, [], 4, 10 * gb)
+    assert [job[1] for job in admitted] == ["large", "small"]
+
+    # next to the subjects already running
+    admitted = _admit(pending, [6 * gb], 4, 10 * gb)
+    assert [job[1] for job in admitted] == ["smaller"]
+
+    # never more than ns_at_once at a time
+    admitted = _admit(pending, [], 1, 10 * gb)
+    assert [job[1] for job in admitted] == ["large"]
+
+    # without a budget, only the number of workers counts
+    admitted = _admit(pending, [], 3)
+    assert [job[1] for job in admitted] == ["large", "mid", "smaller"]
+
+
+
+def test_admit_over_budget():
+
+    from qap.cli import _admit
+
+    gb = 1024**3
+    pending = [(12 * gb, "huge"), (1 * gb, "small")]
+
+    # a subject larger than the whole budget runs on its own ...
+    admitted = _admit(pending, [], 4, 10 * gb)
+    assert [job[1] for job in admitted] == ["huge"]
+
+    # ... once nothing else runs
+    admitted = _admit(pending[:1], [1 * gb], 4, 10 * gb)
+    assert admitted == []
+
+
+
+def test_estimate_peak_memory():
+
+    import os
+    import shutil
+    import tempfile
+
+    import numpy as np
+    import nibabel as nb
+
+    from qap.cli import _estimate_peak_memory
+
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        func = os.path.join(tmp_dir, "func.nii.gz")
+        mask = os.path.join(tmp_dir, "mask.nii.gz")
+        nb.save(nb.Nifti1Image(np.zeros((4, 5, 6, 10), dtype=np.int16),
+                               np.eye(4)), func)
+        nb.save(nb.Nifti1Image(np.zeros((4, 5, 6), dtype=np.uint8),
+                               np.eye(4)), mask)
+
+        resource_pool = {"functional_scan": func,
+                         "functional_brain_mask": mask,
+                         "func_motion_correct": ("node", "out_file")}
+
+        # the largest image as float64, two or three times
+        assert _estimate_peak_memory(resource_pool, "functional_spatial") \
+            == 2 * 4 * 5 * 6 * 10 * 8
+        assert _estimate_peak_memory(resource_pool, "functional_temporal") \
+            == 3 * 4 * 5 * 6 * 10 * 8
+
+        # images that cannot be read are left out
+        resource_pool["functional_scan"] = os.path.join(tmp_dir,
+                                                        "missing.nii.gz")
+        assert _estimate_peak_memory(resource_pool, "functional_spatial") \
+            == 2 * 4 * 5 * 6 * 8
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+
+def test_job_result():
+
+    from qap.cli import _job_result
+
+    class FakeResult(object):
+        def __init__(self, value):
+            self.value = value
+
+        def get(self):
+            if isinstance(self.value, Exception):
+                raise self.value
+            return self.value
+
+    args = ({}, {}, ("sub_1", None, "rest_1"), "run", None)
+
+    rt = {"id": "sub_1", "session": "session_0", "scan": "rest_1",
+          "status": "finished"}
+    assert _job_result(FakeResult(rt), args) == rt
+
+    # a subject that raised before its workflow ran is reported as failed
+    rt = _job_result(FakeResult(IOError("no such file")), args)
+    assert rt["status"] == "failed"
+    assert (rt["id"], rt["session"], rt["scan"]) == \
+        ("sub_1", "session_0", "rest_1")
+    assert "no such file" in str(rt["msg"])
+
+
+
+def test_run_here_failed_scan():
+
+    import os
+    import shutil
+    import tempfile
+
+    import yaml
+
+    import qap.cli as cli
+
+    tmp_dir = tempfile.mkdtemp()
+    sublist = os.path.join(tmp_dir, "sublist.yml")
+
+    def run_scan(args):
+        if args[2][0] == "sub_1":
+            raise IOError("no such file")
+        return {"id": args[2][0], "session": "session_1", "scan": "rest_1",
+                "status": "finished"}
+
+    run_scan_orig = cli._run_scan
+    cli._run_scan = run_scan
+
+    try:
+        with open(sublist, "w") as f:
+            yaml.dump({"sub_1": {"session_1": {"functional_scan": {
+                           "rest_1": "/sub_1.nii.gz"}}},
+                       "sub_2": {"session_1": {"functional_scan": {
+                           "rest_1": "/sub_2.nii.gz"}}}}, f)
+
+        qap = cli.QAProtocolCLI.__new__(cli.QAProtocolCLI)
+        qap._config = {"qap_type": "functional_temporal",
+                       "output_directory": tmp_dir,
+                       "num_subjects_at_once": 1}
+        qap._sub_dict = sublist
+        qap._resume = False
+        qap._report_pool = None
+        qap._reports = {}
+
+        # a scan raising before its workflow runs fails on its own, and
+        # the run goes on
+        results = qap._run_here("run")
+        status = dict((rt["id"], rt["status"]) for rt in results)
+        assert status == {"sub_1": "failed", "sub_2": "finished"}
+
+        journal = cli._read_journal(qap._journal)
+        assert journal[("sub_1", "session_1", "rest_1")] == "failed"
+        assert journal[("sub_2", "session_1", "rest_1")] == "finished"
+
+    finally:
+        cli._run_scan = run_scan_orig
+        shutil.rmtree(tmp_dir)
+
+
+
+def test_core_budget():
+
+    from qap.cli import _core_budget
+
+    # without a budget the settings are used as given
+    assert _core_budget({"num_subjects_at_once": 3,
+                         "num_cores_per_subject": 4}) == (3, 4, None)
+    assert _core_budget({}) == (1, 1, None)
+
+    # with one, subjects x cores x threads never exceeds it
+    for total in range(1, 17):
+        for ns in range(1, 9):
+            for nc in range(1, 9):
+                split = _core_budget({"num_subjects_at_once": ns,
+                                      "num_cores_per_subject": nc,
+                                      "num_cores_total": total})
+                assert split[0] * split[1] * split[2] <= total
+                assert split[0] <= ns and split[1] <= nc
+                assert min(split) >= 1
+
+    # the cores of a subject not used by parallel nodes go to threads
+    assert _core_budget({"num_subjects_at_once": 2,
+                         "num_cores_per_subject": 2,
+                         "num_cores_total": 12}) == (2, 2, 3)
+
+    # and everything is clamped to one core
+    assert _core_budget({"num_subjects_at_once": 4,
+                         "num_cores_per_subject": 4,
+                         "num_cores_total": 2}) == (2, 1, 1)
+
+
+
+def test_run_workflow_thread_env():
+
+    import os
+
+    import qap.cli as cli
+
+    seen = []
+
+    def run_scan(args):
+        seen.append((os.environ.get("OMP_NUM_THREADS"),
+                     os.environ.get("QAP_IMAGE_CACHE_MB")))
+        return {"status": "finished"}
+
+    run_scan_orig = cli._run_scan
+    omp_orig = os.environ.pop("OMP_NUM_THREADS", None)
+    cache_orig = os.environ.pop("QAP_IMAGE_CACHE_MB", None)
+    os.environ["MKL_NUM_THREADS"] = "7"
+    cli._run_scan = run_scan
+
+    try:
+        config = {"num_subjects_at_once": 1, "num_cores_per_subject": 1,
+                  "num_cores_total": 4, "image_cache_mb": 512}
+        assert cli._run_workflow(({}, config, ("sub_1", None, None), "run",
+                                  None)) == {"status": "finished"}
+
+        # the threads and the image cache are set for the scan only
+        assert seen == [("4", "512")]
+        assert "OMP_NUM_THREADS" not in os.environ
+        assert "QAP_IMAGE_CACHE_MB" not in os.environ
+        assert os.environ["MKL_NUM_THREADS"] == "7"
+
+    finally:
+        cli._run_scan = run_scan_orig
+        os.environ.pop("MKL_NUM_THREADS", None)
+        if omp_orig is not None:
+            os.environ["OMP_NUM_THREADS"] = omp_orig
+        if cache_orig is not None:
+            os.environ["QAP_IMAGE_CACHE_MB"] = cache_orig
+
+
+
+def test_cli_thread_env():
+
+    import os
+    import shutil
+    import sys
+    import tempfile
+
+    import yaml
+
+    from qap.cli import QAProtocolCLI, THREAD_ENV_VARS
+
+    tmp_dir = tempfile.mkdtemp()
+    config_file = os.path.join(tmp_dir, "pipeline_config.yml")
+
+    argv_orig = sys.argv
+    saved = dict((env_var, os.environ.pop(env_var, None))
+                 for env_var in THREAD_ENV_VARS)
+
+    try:
+        with open(config_file, "w") as f:
+            yaml.dump({"num_subjects_at_once": 2, "num_cores_per_subject": 1,
+                       "num_cores_total": 8}, f)
+
+        sys.argv = ["qap_functional_temporal.py", "--sublist",
+                    os.path.join(tmp_dir, "sublist.yml"), config_file]
+        QAProtocolCLI()
+
+        # the thread budget is in the environment of the driver, before
+        # the measures load numpy
+        for env_var in THREAD_ENV_VARS:
+            assert os.environ[env_var] == "4"
+
+    finally:
+        sys.argv = argv_orig
+        for env_var, value in saved.items():
+            if value is None:
+                os.environ.pop(env_var, None)
+            else:
+                os.environ[env_var] = value
+        shutil.rmtree(tmp_dir)
+
+
+
+def test_journal():
+
+    import os
+    import shutil
+    import tempfile
+
+    from qap.cli import _journal_append, _read_journal
+
+    tmp_dir = tempfile.mkdtemp()
+    journal_file = os.path.join(tmp_dir, "qap_journal.jsonl")
+
+    def scan(subject, status):
+        return {"event": "scan", "subject": subject, "session": "session_1",
+                "scan": "rest_1", "status": status}
+
+    try:
+        # no journal yet
+        assert _read_journal(journal_file) == {}
+
+        _journal_append(journal_file, {"event": "run", "scans": 2})
+        _journal_append(journal_file, scan("sub_1", "started"))
+        _journal_append(journal_file, scan("sub_1", "failed"))
+        _journal_append(journal_file, scan("sub_1", "finished"))
+        _journal_append(journal_file, scan("sub_2", "started"))
+
+        # the last status of every scan wins
+        assert _read_journal(journal_file) == \
+            {("sub_1", "session_1", "rest_1"): "finished",
+             ("sub_2", "session_1", "rest_1"): "started"}
+
+        # a record cut short by a crash is ignored ...
+        with open(journal_file, "ab") as f:
+            f.write(b'{"event": "scan", "subject": "sub_2", "sess')
+
+        assert _read_journal(journal_file)[
+            ("sub_2", "session_1", "rest_1")] == "started"
+
+        # ... and the next one starts on a new line
+        _journal_append(journal_file, scan("sub_2", "cached"))
+
+        assert _read_journal(journal_file)[
+            ("sub_2", "session_1", "rest_1")] == "cached"
+
+        with open(journal_file, "r") as f:
+            assert len(f.readlines()) == 7
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+
+def test_pending_scans():
+
+    from qap.cli import _pending_scans
+
+    journal = {("sub_1", "session_0", "scan_0"): "finished",
+               ("sub_2", "session_0", "scan_0"): "cached",
+               ("sub_3", "session_0", "scan_0"): "failed",
+               ("sub_4", "session_0", "scan_0"): "started"}
+
+    wfargs = [({}, {}, (sub_id, None, None), "run", None)
+              for sub_id in ["sub_1", "sub_2", "sub_3", "sub_4", "sub_5"]]
+
+    # only the scans done are skipped; the failed, interrupted and new
+    # ones run again
+    assert [a[2][0] for a in _pending_scans(wfargs, journal)] == \
+        ["sub_3", "sub_4", "sub_5"]
+
+
+
+def run_all_tests_cli():
+
+    test_admit()
+    test_admit_over_budget()
+    test_estimate_peak_memory()
+    test_job_result()
+    test_run_here_failed_scan()
+    test_core_budget()
+    test_run_workflow_thread_env()
+    test_cli_thread_env()
+    test_journal()
+    test_pending_scans()
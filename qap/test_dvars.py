@@ -47,6 +47,47 @@ def test_remove_zero_variance_voxels():
 
 
 
+def test_remove_zero_variance_voxels_chunked():
+
+    import os
+    import pickle
+    import pkg_resources as p
+    
+    import nibabel as nb
+    
+    from qap.dvars import remove_zero_variance_voxels
+
+    func_motion = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                      "rest_1", \
+                                      "func_motion_correct", \
+                                      "rest_calc_tshift_resample_" \
+                                      "volreg.nii.gz"))
+                                      
+    func_mask = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                    "rest_1", \
+                                    "functional_brain_mask", \
+                                    "rest_calc_tshift_resample_volreg" \
+                                    "_mask.nii.gz"))
+                                    
+    ref_out = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                  "rest_1", \
+                                  "dvars_data", \
+                                  "no_zero_variance_voxels_mask.p"))
+                                   
+    func_data = nb.load(func_motion).get_data()
+    mask_data = nb.load(func_mask).get_data()
+
+    # a chunk size that does not divide the number of masked voxels
+    out_mask_data = remove_zero_variance_voxels(func_data, mask_data, \
+                                                chunk_size=997)
+                                    
+    with open(ref_out, "r") as f:
+        ref_mask_data = pickle.load(f)
+
+    assert (ref_mask_data == out_mask_data).all()
+
+
+
 def test_load():
 
     import os
@@ -135,7 +176,7 @@ def test_ar1():
     
     import nibabel as nb
     
-    from qap.dvars import ar1
+    from qap.dvars import ar1, ar_nitime
 
     func_data_file = p.resource_filename("qap", os.path.join(test_sub_dir, \
                                          "rest_1", \
@@ -154,7 +195,7 @@ def test_ar1():
         ref_out_data = pickle.load(f)
         
         
-    func_out_data = ar1(func_data)
+    func_out_data = ar1(func_data, ar_nitime)
         
         
     # create a vector of True and False values
@@ -164,9 +205,106 @@ def test_ar1():
                                     
                                 
 
+def test_ar_batched():
+
+    import os
+    import pickle
+    import pkg_resources as p
+
+    import numpy as np
+    
+    from qap.dvars import ar1, ar_batched, ar_nitime
+
+    func_data_file = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                         "rest_1", \
+                                         "dvars_data", \
+                                         "loaded_func.p"))
+
+    with open(func_data_file, "r") as f:
+        func_data = pickle.load(f)
+
+    ref_out_data = ar1(func_data, ar_nitime)
+
+    # the batched estimator is the closed form of the order-1 Yule-Walker
+    # solve, so it only differs from nitime by floating point round-off
+    func_out_data = ar_batched(func_data, chunk_size=7)
+
+    np.testing.assert_allclose(func_out_data, ref_out_data, rtol=1e-10, \
+                               atol=1e-12)
+
+
+
+def test_calc_dvars_blocks():
+
+    import os
+    import pickle
+    import pkg_resources as p
+
+    import numpy as np
+
+    from qap.dvars import calc_dvars
+
+    func_data_file = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                         "rest_1", \
+                                         "dvars_data", \
+                                         "loaded_func.p"))
+
+    with open(func_data_file, "r") as f:
+        func_data = pickle.load(f)
+
+    ref_out_data = calc_dvars(func_data, output_all=True)
+
+    # the per-frame moments are merged across blocks, so the streamed DVARS
+    # only differ by floating point round-off
+    func_out_data = calc_dvars(func_data, output_all=True, block_size=77)
+
+    np.testing.assert_allclose(func_out_data, ref_out_data, rtol=1e-10)
+
+
+
+def test_iter_masked_blocks():
+
+    import os
+    import pkg_resources as p
+
+    import numpy as np
+
+    from qap.dvars import load, iter_masked_blocks
+
+    func_file = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                    "rest_1", \
+                                    "func_motion_correct", \
+                                    "rest_calc_tshift_resample_" \
+                                    "volreg.nii.gz"))
+
+    mask_file = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                    "rest_1", \
+                                    "functional_brain_mask", \
+                                    "rest_calc_tshift_resample_volreg" \
+                                    "_mask.nii.gz"))
+
+    func_data = load(func_file, mask_file)
+
+    blocks = list(iter_masked_blocks(func_file, mask_file, block_size=500))
+
+    assert max([block.shape[1] for block in blocks]) <= 500
+
+    # same voxels, visited slab by slab
+    block_data = np.hstack(blocks)
+
+    assert block_data.shape == func_data.shape
+    np.testing.assert_allclose(np.sort(block_data.sum(0)), \
+                               np.sort(func_data.sum(0)))
+
+
+
 def run_all_tests_dvars():
 
     test_remove_zero_variance_voxels()
+    test_remove_zero_variance_voxels_chunked()
     test_load()
     test_robust_stdev()
-    test_ar1()
\ No newline at end of file
+    test_ar1()
+    test_ar_batched()
+    test_calc_dvars_blocks()
+    test_iter_masked_blocks()
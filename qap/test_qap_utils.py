@@ -0,0 +1,121 @@
+
+
+def test_load_image_data_cache():
+
+    import os
+    import shutil
+    import tempfile
+
+    import nibabel as nb
+    import numpy as np
+
+    from qap.qap_utils import load_image_data, clear_image_cache
+
+    tmp_dir = tempfile.mkdtemp()
+    image_files = [os.path.join(tmp_dir, "image_%d.nii.gz" % i)
+                   for i in range(3)]
+
+    for image_file in image_files:
+        # 10 x 10 x 10 float64 images, 8000 bytes of data each
+        nb.save(nb.Nifti1Image(np.random.rand(10, 10, 10), np.eye(4)),
+                image_file)
+
+    old_budget = os.environ.get("QAP_IMAGE_CACHE_MB")
+    os.environ["QAP_IMAGE_CACHE_MB"] = str(20000 / 1024.0**2)
+    clear_image_cache()
+
+    try:
+        first = load_image_data(image_files[0])
+
+        # served from the cache, and protected from modification
+        assert load_image_data(image_files[0]) is first
+        assert not first.flags.writeable
+
+        # only two images fit: the least recently used one is evicted
+        load_image_data(image_files[1])
+        load_image_data(image_files[2])
+        assert load_image_data(image_files[0]) is not first
+
+        # a rewritten file is not served from the cache
+        second = load_image_data(image_files[1])
+        nb.save(nb.Nifti1Image(np.zeros((10, 10, 10)), np.eye(4)),
+                image_files[1])
+        os.utime(image_files[1], (0, 0))
+        assert (load_image_data(image_files[1]) == 0).all()
+
+    finally:
+        if old_budget is None:
+            del os.environ["QAP_IMAGE_CACHE_MB"]
+        else:
+            os.environ["QAP_IMAGE_CACHE_MB"] = old_budget
+        clear_image_cache()
+        shutil.rmtree(tmp_dir)
+
+
+
+def test_is_binary_mask():
+
+    import numpy as np
+
+    from qap.qap_utils import is_binary_mask
+
+    mask = np.zeros((10, 11, 40), dtype=np.uint8)
+    mask[2:5, 2:5, 3:30] = 1
+
+    assert is_binary_mask(mask, chunk_size=7)
+    assert is_binary_mask(mask.astype(np.float32), chunk_size=7)
+
+    # values other than 0 and 1, or only one of them
+    assert not is_binary_mask(mask * 2, chunk_size=7)
+    assert not is_binary_mask(np.zeros_like(mask), chunk_size=7)
+    assert not is_binary_mask(mask + 0.5 * (mask == 0), chunk_size=7)
+
+
+
+def test_load_mask_affine():
+
+    import os
+    import shutil
+    import tempfile
+
+    import nibabel as nb
+    import numpy as np
+
+    from qap.qap_utils import load_mask
+
+    tmp_dir = tempfile.mkdtemp()
+    ref_file = os.path.join(tmp_dir, "anat.nii.gz")
+    mask_file = os.path.join(tmp_dir, "mask.nii.gz")
+    shifted_file = os.path.join(tmp_dir, "mask_shifted.nii.gz")
+
+    mask = np.zeros((10, 10, 10), dtype=np.uint8)
+    mask[3:7, 3:7, 3:7] = 1
+
+    shifted = np.eye(4)
+    shifted[:3, 3] = [0, 0, 5]
+
+    try:
+        nb.save(nb.Nifti1Image(np.random.rand(10, 10, 10), np.eye(4)),
+                ref_file)
+        nb.save(nb.Nifti1Image(mask, np.eye(4)), mask_file)
+        nb.save(nb.Nifti1Image(mask, shifted), shifted_file)
+
+        assert (load_mask(mask_file, ref_file) == mask).all()
+
+        # a mask of the same dimensions in another space is refused
+        try:
+            load_mask(shifted_file, ref_file)
+            assert False
+        except Exception as e:
+            assert "not in the same space" in str(e)
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+
+def run_all_tests_qap_utils():
+
+    test_load_image_data_cache()
+    test_is_binary_mask()
+    test_load_mask_affine()
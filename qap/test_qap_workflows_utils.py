@@ -22,6 +22,32 @@ def test_select_thresh():
 
 
 
+def test_hist_thresh():
+
+    import numpy as np
+
+    from qap.qap_workflows_utils import hist_thresh
+
+    # mean 11.69, so the histogram spans 0-35.07 in bins of 3.5; the bins
+    # starting at 3.5 and 24.5 hold one voxel each, the empty ones are
+    # skipped and the higher of the two wins
+    skull_data = np.array([0] * 40 + [4] + [12] * 20 + [18] * 20 + [25] + \
+                          [30] * 18)
+
+    assert hist_thresh(skull_data) == 24
+
+    # the range is not truncated to whole intensities, so images with a
+    # low average still have one ...
+    assert hist_thresh(skull_data / 100.0) == 0
+
+    # ... and those whose average is too low to span a range at all (here,
+    # all negative) fall back to the image maximum: the histogram spans
+    # -100 to -70, and the bin starting at -76 holds the voxel at -75
+    assert hist_thresh(skull_data - 100.0) == -76
+    assert hist_thresh(np.zeros(100)) == 0
+
+
+
 def test_slice_head_mask():
 
     import os
@@ -75,6 +101,54 @@ def test_slice_head_mask():
     
     
     
+def test_create_head_mask():
+
+    import os
+    import pkg_resources as p
+
+    import nibabel as nb
+    import numpy as np
+
+    from qap.qap_workflows_utils import create_head_mask
+
+    infile = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                 "anat_1", \
+                                 "anatomical_reorient", \
+                                 "mprage_resample.nii.gz"))
+
+    transform = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                    "anat_1", \
+                                    "qap_headmask_c3d_xfm", \
+                                    "qc_fsl_affine_xfm.mat"))
+
+    standard = p.resource_filename("qap", os.path.join("test_data", \
+                                   "MNI152_T1_2mm.nii.gz"))
+
+    # the mask written by the former fslmaths chain
+    test_mask = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                    "anat_1", \
+                                    "qap_head_mask", \
+                                    "mprage_resample_thresh_maths_maths_" \
+                                    "maths.nii.gz"))
+
+    head_mask_path = create_head_mask(infile, transform, standard)
+    head_mask_data = nb.load(head_mask_path).get_data()
+
+    test_mask_data = nb.load(test_mask).get_data() > 0
+
+    os.system("rm %s" % head_mask_path)
+
+    assert head_mask_data.dtype == np.uint8
+    assert head_mask_data.shape == test_mask_data.shape
+
+    # fslmaths and scipy may treat the voxels at the edge of the field of
+    # view differently; anything beyond 0.1% of the head is a regression
+    n_diff = ((head_mask_data > 0) != test_mask_data).sum()
+
+    assert n_diff <= 0.001 * test_mask_data.sum()
+
+
+
 def test_qap_anatomical_spatial():
 
     import os
@@ -115,7 +189,7 @@ def test_qap_anatomical_spatial():
     qc = qap_anatomical_spatial(anat, head_mask, gm_path, wm_path, csf_path, \
                                     subject, session, scan)
 
-    assert (len(qc.keys()) == 27) and (None not in qc.values())
+    assert (len(qc.keys()) == 28) and (None not in qc.values())
 
 
 
@@ -149,7 +223,7 @@ def test_qap_functional_spatial():
                                     session, scan)
 
 
-    assert (len(qc.keys()) == 17) and (None not in qc.values())
+    assert (len(qc.keys()) == 18) and (None not in qc.values())
 
 
 
@@ -188,12 +262,75 @@ def test_qap_functional_temporal():
 
 
 
+def test_select_measures():
+
+    from qap.qap_utils import select_measures, measure_inputs
+
+    # everything by default, in registry order
+    assert select_measures("functional_temporal") == \
+        ["dvars", "tsnr", "fd", "outlier", "quality", "gcor"]
+
+    # measures pull in the ones they are derived from, and names of the
+    # other pipelines are ignored
+    selected = select_measures("anatomical_spatial", ["cnr", "dvars"])
+    assert selected == ["summary", "tissue", "cnr"]
+
+    selected = select_measures("anatomical_spatial", ["efc", "qi1"])
+    assert "anatomical_gm_mask" not in \
+        measure_inputs("anatomical_spatial", selected)
+
+    # the quality index is calculated within the brain mask
+    assert "functional_brain_mask" in \
+        measure_inputs("functional_temporal", ["quality"])
+
+    try:
+        select_measures("functional_spatial", ["fber", "not_a_measure"])
+        assert False
+    except Exception as e:
+        assert "not_a_measure" in str(e)
+
+
+
+def test_qap_anatomical_spatial_measures():
+
+    import os
+    import pkg_resources as p
+
+    from qap.qap_workflows_utils import qap_anatomical_spatial
+
+    anat = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                               "anat_1", \
+                               "anatomical_reorient", \
+                               "mprage_resample.nii.gz"))
+
+    head_mask = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                    "anat_1", \
+                                    "qap_head_mask", \
+                                    "mprage_resample_thresh_maths_maths_" \
+                                    "maths.nii.gz"))
+
+    # the segmentation is never loaded, but every column is still there
+    qc = qap_anatomical_spatial(anat, head_mask, None, None, None, \
+                                "1019436", "session_1", "anat_1", \
+                                measures=["efc", "snr"])
+
+    assert len(qc.keys()) == 28
+    assert None not in (qc['efc'], qc['snr'], qc['fg_mean'], qc['bg_std'])
+    assert (qc['cnr'] is None) and (qc['gm_mean'] is None) and \
+        (qc['qi1'] is None) and (qc['fwhm'] is None)
+
+
+
 def run_all_tests_qap_workflows_utils():
 
     test_select_thresh()
+    test_hist_thresh()
     test_slice_head_mask()
+    test_create_head_mask()
     test_qap_anatomical_spatial()
     test_qap_functional_spatial()
     test_qap_functional_temporal()
+    test_select_measures()
+    test_qap_anatomical_spatial_measures()
   
 
@@ -31,6 +31,49 @@ def test_summary_mask():
     
     
     
+def test_summary_masks():
+
+    import os
+    import pkg_resources as p
+
+    import numpy as np
+
+    from qap.spatial_qc import summary_mask, summary_masks, fber
+    from qap.qap_utils import load_image, load_mask
+
+    anat_reorient = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                        "anat_1", \
+                                        "anatomical_reorient", \
+                                        "mprage_resample.nii.gz"))
+                                   
+    head_mask = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                    "anat_1", \
+                                    "qap_head_mask", \
+                                    "mprage_resample_thresh_maths_maths_" \
+                                    "maths.nii.gz"))
+
+    gm_path = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                  "anat_1", \
+                                  "anatomical_gm_mask", \
+                                  "segment_seg_1.nii.gz"))
+
+    anat_data = load_image(anat_reorient)
+    mask_data = load_mask(head_mask, anat_reorient)
+    gm_data = load_mask(gm_path, anat_reorient)
+
+    summary = summary_masks(anat_data, mask_data, {'gm': gm_data})
+
+    for name, mask in (('fg', mask_data), ('bg', 1 - mask_data), \
+                       ('gm', gm_data)):
+        mean, std, size = summary_mask(anat_data, mask)
+        np.testing.assert_allclose(summary[name][:2], (mean, std))
+        assert summary[name][2] == size
+
+    np.testing.assert_allclose(summary['fg'][3] / summary['bg'][3], \
+                               fber(anat_data, mask_data), rtol=1e-6)
+    
+    
+    
 def test_check_datatype():
 
     import numpy as np
@@ -64,6 +107,35 @@ def test_check_datatype():
     
     
     
+def test_clip_negatives():
+
+    import numpy as np
+
+    from qap.spatial_qc import clip_negatives
+
+    img_data = np.arange(-5, 19, dtype=np.int32).reshape(2, 3, 4)
+
+    clipped, n_clipped = clip_negatives(img_data)
+
+    assert n_clipped == 5
+    assert clipped.min() == 0
+    assert img_data.min() == -5
+
+    # in place: no copy, the input itself is zeroed
+    clipped, n_clipped = clip_negatives(img_data, in_place=True)
+
+    assert n_clipped == 5
+    assert clipped is img_data
+    assert img_data.min() == 0
+
+    # nothing to clip
+    clipped, n_clipped = clip_negatives(img_data)
+
+    assert n_clipped == 0
+    assert clipped is img_data
+
+
+
 def test_snr():
 
     from qap.spatial_qc import snr
@@ -171,9 +243,39 @@ def test_artifacts_no_qi2():
 
 
 
-def test_artifacts():
+def test_artifacts_crop():
+
+    import numpy as np
+
+    from qap.spatial_qc import artifacts
+
+    np.random.seed(1)
 
-    ''' this will fail until the code in 'if calculate_qi2' is updated '''
+    shape = (60, 70, 50)
+    mask_data = np.zeros(shape, dtype=np.int16)
+    mask_data[20:40, 25:50, 15:35] = 1
+
+    # Poisson noise with scattered bright voxels and two artifact blobs,
+    # one in a corner of the field of view
+    anat_data = np.random.poisson(3, shape).astype(np.int32)
+    anat_data[np.random.rand(*shape) < 0.05] += 20
+    anat_data[5:9, 5:12, 40:44] += 30
+    anat_data[0:3, 0:4, 0:3] += 40
+    anat_data[mask_data == 1] = 500
+
+    cropped = artifacts(anat_data, mask_data, calculate_qi2=False)
+    full = artifacts(anat_data, mask_data, calculate_qi2=False, crop=False)
+
+    assert cropped == full
+
+    # floating point data is compared as its integer cast
+    cropped = artifacts(anat_data + 0.5, mask_data, calculate_qi2=False)
+
+    assert cropped == full
+
+
+
+def test_artifacts():
 
     import os
     import pickle
@@ -198,8 +300,31 @@ def test_artifacts():
 
     art_out = artifacts(anat_data, mask_data, calculate_qi2=True)
 
-    ''' not the actual expected output, needs verification '''
-    assert art_out == 0
+    # QI1 is unchanged, QI2 adds the (non-negative) goodness of fit
+    assert art_out[0] == 0.06788309163289169
+    assert art_out[1] >= art_out[0]
+
+
+
+def test_chi_goodness_of_fit():
+
+    import numpy as np
+    import scipy.stats as ss
+
+    from qap.spatial_qc import chi_goodness_of_fit
+
+    np.random.seed(0)
+
+    # noise that follows a chi distribution fits well...
+    noise = np.round(ss.chi.rvs(2, scale=5, size=200000)).astype(np.int32)
+    gof = chi_goodness_of_fit(noise)
+
+    assert gof < 0.01
+
+    # ...but not once a uniform component is added to the tail
+    noise = np.concatenate((noise, np.random.randint(20, 60, 40000)))
+
+    assert chi_goodness_of_fit(noise) > 5 * gof
 
 
 
@@ -254,13 +379,47 @@ def test_fwhm_no_out_vox():
 
 
 
+def test_calc_fwhm():
+
+    import os
+    import pkg_resources as p
+
+    import numpy as np
+    
+    from qap.spatial_qc import calc_fwhm
+    from qap.qap_utils import load_image, load_mask, get_pixdim
+
+    anat_file = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                    "anat_1", \
+                                    "anatomical_reorient", \
+                                    "mprage_resample.nii.gz"))
+    
+    mask_file = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                    "anat_1", \
+                                    "qap_head_mask", \
+                                    "mprage_resample_thresh_maths_" \
+                                    "maths_maths.nii.gz"))
+
+    anat_data = load_image(anat_file)
+    mask_data = load_mask(mask_file, anat_file)
+
+    fwhm_out = calc_fwhm(anat_data, mask_data, get_pixdim(anat_file))
+
+    # same estimator as 3dFWHMx, see test_fwhm_no_out_vox
+    np.testing.assert_allclose(fwhm_out, (3.86460, 4.24367, 4.41525, \
+                                          4.16806), rtol=1e-3)
+
+
+
 def test_ghost_direction():
 
     import os
     import pickle
     import pkg_resources as p
     
-    from qap.spatial_qc import ghost_direction
+    import numpy as np
+
+    from qap.spatial_qc import ghost_direction, ghost_directions
     from qap.qap_utils import load_image, load_mask
 
     mean_epi = p.resource_filename("qap", os.path.join(test_sub_dir, \
@@ -286,22 +445,36 @@ def test_ghost_direction():
 
     print gsr_out_all
 
-    assert gsr_out_all == (-0.013489312, 0.016911652, 0.080058813)
+    # the means are now taken in double precision, the reference values
+    # were float32
+    np.testing.assert_allclose(gsr_out_all, \
+                               (-0.013489312, 0.016911652, 0.080058813), \
+                               rtol=1e-4)
+
+    # all directions at once, from the shared sums
+    np.testing.assert_allclose(ghost_directions(mean_epi_data, \
+                                                funcmask_data), \
+                               gsr_out_all)
 
 
 
 def run_all_tests_spatial_qc():
 
     test_summary_mask()
+    test_summary_masks()
     test_check_datatype()
+    test_clip_negatives()
     test_snr()
     test_cnr()
     test_fber()
     test_efc()
     test_artifacts_no_qi2()
-    #test_artifacts()
+    test_artifacts_crop()
+    test_artifacts()
+    test_chi_goodness_of_fit()
     test_fwhm_out_vox()
     test_fwhm_no_out_vox()
+    test_calc_fwhm()
     test_ghost_direction()
 
     
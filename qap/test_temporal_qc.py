@@ -7,8 +7,10 @@ def test_fd_jenkinson():
     import os
     import pickle
     import pkg_resources as p
-    
-    from qap.temporal_qc import fd_jenkinson
+
+    import numpy as np
+
+    from qap.temporal_qc import fd_jenkinson, fd_sidecar, load_fd
 
     coord_xfm = p.resource_filename("qap", os.path.join(test_sub_dir, \
                                     "rest_1", \
@@ -21,21 +23,21 @@ def test_fd_jenkinson():
                                   "FD_J.1D"))                                    
 
     meanfd = fd_jenkinson(coord_xfm)
-    
-    # do da check
-    with open(meanfd,"r") as f:
-        test_fd_lines = f.readlines()
-        
-    with open(ref_out,"r") as f:
-        ref_fd_lines = f.readlines()
-        
-        
-    os.system("rm FD_J.1D")
-        
-    
-    assert test_fd_lines == ref_fd_lines
-    
-    
+
+    # do da check (the frames are processed as one stack, so the values
+    # only agree with the reference to rounding)
+    test_fd = np.loadtxt(meanfd)
+    ref_fd = np.loadtxt(ref_out)
+
+    # the binary sidecar holds the same time series
+    sidecar_fd = load_fd(meanfd)
+
+    os.system("rm %s %s" % (meanfd, fd_sidecar(meanfd)))
+
+    np.testing.assert_allclose(test_fd, ref_fd, rtol=1e-12, atol=1e-15)
+    np.testing.assert_array_equal(sidecar_fd, test_fd)
+
+
 
 def test_summarize_fd():
 
@@ -110,6 +112,48 @@ def test_outlier_timepoints():
     
     
     
+def test_calc_outlier_timepoints():
+
+    import os
+    import pickle
+    import pkg_resources as p
+
+    import nibabel as nb
+    import numpy as np
+    
+    from qap.temporal_qc import calc_outlier_timepoints
+
+    func_motion = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                      "rest_1", \
+                                      "func_motion_correct", \
+                                      "rest_calc_tshift_resample_" \
+                                      "volreg.nii.gz"))
+                                  
+    func_mask = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                    "rest_1", \
+                                    "functional_brain_mask", \
+                                    "rest_calc_tshift_resample_volreg" \
+                                    "_mask.nii.gz"))
+
+    # stored 3dToutcount output for the same data
+    ref_out = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                  "rest_1", \
+                                  "outlier_timepoints", \
+                                  "outlier_timepoints_ref_out.p"))
+
+    func_data = nb.load(func_motion).get_data()
+    mask_data = nb.load(func_mask).get_data()
+    func = func_data[mask_data.nonzero()].astype(np.float64).T
+
+    out_list = calc_outlier_timepoints(func)
+
+    with open(ref_out, "r") as f:
+        ref_list = pickle.load(f)
+
+    np.testing.assert_allclose(out_list, ref_list, atol=1e-3)
+
+
+
 def test_quality_timepoints():
 
     import os
@@ -168,11 +212,49 @@ def test_quality_timepoints_no_automask():
 
 
 
+def test_calc_quality_timepoints():
+
+    import os
+    import pkg_resources as p
+
+    import nibabel as nb
+    import numpy as np
+    import scipy.stats as stats
+    
+    from qap.temporal_qc import calc_quality_timepoints
+
+    func_motion = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                      "rest_1", \
+                                      "func_motion_correct", \
+                                      "rest_calc_tshift_resample_" \
+                                      "volreg.nii.gz"))
+                                  
+    func_mask = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                    "rest_1", \
+                                    "functional_brain_mask", \
+                                    "rest_calc_tshift_resample_volreg" \
+                                    "_mask.nii.gz"))
+
+    func_data = nb.load(func_motion).get_data()
+    mask_data = nb.load(func_mask).get_data()
+    func = func_data[mask_data.nonzero()].astype(np.float64).T
+
+    out_list = calc_quality_timepoints(func, chunk_size=1000)
+
+    median_vol = np.median(func, 0)
+    ref_list = [1 - stats.spearmanr(vol, median_vol)[0] for vol in func]
+
+    np.testing.assert_allclose(out_list, ref_list)
+
+
+
 def test_global_correlation():
 
     import os
     import pkg_resources as p
 
+    import numpy as np
+
     from qap.temporal_qc import global_correlation
 
     func_motion = p.resource_filename("qap", os.path.join(test_sub_dir, \
@@ -189,8 +271,100 @@ def test_global_correlation():
 
     gcor = global_correlation(func_motion, func_mask)
 
+    # the z-scores are summed block-wise, so only agree to rounding
+    np.testing.assert_allclose(gcor, 0.0090767564485253263, rtol=1e-12)
+
+
+
+def test_calc_global_correlation():
+
+    import numpy as np
+    import scipy.stats
+
+    from qap.temporal_qc import calc_global_correlation
+
+    np.random.seed(4)
+    func = np.random.normal(size=(120, 3001)) + \
+        0.3 * np.random.normal(size=(120, 1)) + 100
+
+    # reference: z-score every voxel, average, correlate
+    zscored = np.asarray([scipy.stats.mstats.zscore(ts) for ts in func.T])
+    avg_ts = zscored.mean(0)
+    ref_gcor = avg_ts.dot(avg_ts) / len(avg_ts)
+
+    np.testing.assert_allclose(calc_global_correlation(func), ref_gcor,
+                               rtol=1e-12)
+    np.testing.assert_allclose(calc_global_correlation(func, chunk_size=97),
+                               ref_gcor, rtol=1e-12)
+
 
-    assert gcor == 0.0090767564485253263
+
+def test_temporal_metrics():
+
+    import os
+    import pkg_resources as p
+
+    import numpy as np
+
+    from qap.temporal_qc import temporal_metrics, global_correlation
+    from qap.dvars import mean_dvars_wrapper
+
+    func_motion = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                      "rest_1", \
+                                      "func_motion_correct", \
+                                      "rest_calc_tshift_resample_" \
+                                      "volreg.nii.gz"))
+                                  
+    func_mask = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                    "rest_1", \
+                                    "functional_brain_mask", \
+                                    "rest_calc_tshift_resample_volreg" \
+                                    "_mask.nii.gz"))
+
+    metrics = temporal_metrics(func_motion, func_mask)
+
+    # the single-load engine must agree with the standalone measures
+    np.testing.assert_allclose(metrics["dvars"], \
+                               mean_dvars_wrapper(func_motion, func_mask))
+    np.testing.assert_allclose(metrics["gcor"], \
+                               global_correlation(func_motion, func_mask))
+
+    assert metrics["m_tsnr"] > 0
+
+
+
+def test_temporal_metrics_blocks():
+
+    import os
+    import pkg_resources as p
+
+    import numpy as np
+
+    from qap.temporal_qc import temporal_metrics
+
+    func_motion = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                      "rest_1", \
+                                      "func_motion_correct", \
+                                      "rest_calc_tshift_resample_" \
+                                      "volreg.nii.gz"))
+
+    func_mask = p.resource_filename("qap", os.path.join(test_sub_dir, \
+                                    "rest_1", \
+                                    "functional_brain_mask", \
+                                    "rest_calc_tshift_resample_volreg" \
+                                    "_mask.nii.gz"))
+
+    metrics = temporal_metrics(func_motion, func_mask)
+
+    # streaming the memory-mapped file in small blocks gives the same
+    # measures as the in-memory pass (up to the order of the sums)
+    blocks = temporal_metrics(func_motion, func_mask, dvars_block_size=500)
+
+    assert sorted(blocks.keys()) == sorted(metrics.keys())
+
+    for measure in metrics.keys():
+        np.testing.assert_allclose(blocks[measure], metrics[measure], \
+                                   rtol=1e-12)
 
 
 
@@ -200,9 +374,11 @@ def run_all_tests_temporal_qc():
     test_summarize_fd()
     test_summarize_fd_threshold_01()
     test_outlier_timepoints()
+    test_calc_outlier_timepoints()
     test_quality_timepoints()
     test_quality_timepoints_no_automask()
+    test_calc_quality_timepoints()
     test_global_correlation()
-    
-    
-    
+    test_calc_global_correlation()
+    test_temporal_metrics()
+    test_temporal_metrics_blocks()
@@ -4,7 +4,6 @@
 import math
 import os.path as op
 import numpy as np
-import nibabel as nb
 import pandas as pd
 
 import matplotlib
@@ -14,6 +13,8 @@ from matplotlib.gridspec import GridSpec
 from matplotlib.backends.backend_pdf import FigureCanvasPdf as FigureCanvas
 import seaborn as sns
 
+from qap.qap_utils import load_image_data
+
 
 def plot_measures(df, measures, ncols=4, title='Group level report',
                   subject=None, figsize=(8.27, 11.69)):
@@ -136,8 +137,7 @@ def plot_mosaic(nifti_file, title=None, overlay_mask=None,
     from pylab import cm
 
     if isinstance(nifti_file, string_types):
-        nii = nb.load(nifti_file)
-        mean_data = nii.get_data()
+        mean_data = load_image_data(nifti_file)
     else:
         mean_data = nifti_file
 
@@ -156,7 +156,7 @@ def plot_mosaic(nifti_file, title=None, overlay_mask=None,
     row, col = _calc_rows_columns(figsize[0] / figsize[1], n_images)
 
     if overlay_mask:
-        overlay_data = nb.load(overlay_mask).get_data()
+        overlay_data = load_image_data(overlay_mask)
 
     # create figures
     fig = plt.Figure(figsize=figsize)
@@ -286,20 +286,10 @@ def _calc_rows_columns(ratio, n_images):
 
 
 def _calc_fd(fd_file):
-    lines = open(fd_file, 'r').readlines()
-    rows = [[float(x) for x in line.split()] for line in lines]
-    cols = np.array([list(col) for col in zip(*rows)])
-
-    translations = np.transpose(np.abs(np.diff(cols[0:3, :])))
-    rotations = np.transpose(np.abs(np.diff(cols[3:6, :])))
-
-    FD_power = np.sum(translations, axis=1) + \
-        (50 * 3.141 / 180) * np.sum(rotations, axis=1)
-
-    # FD is zero for the first time point
-    FD_power = np.insert(FD_power, 0, 0)
+    from qap.temporal_qc import load_fd
 
-    return FD_power
+    # the FD_J series written by fd_jenkinson, as used for the measures
+    return load_fd(fd_file)
 
 
 def _get_mean_fd_distribution(fd_files):
@@ -314,10 +304,9 @@ def _get_mean_fd_distribution(fd_files):
 
 
 def _get_values_inside_a_mask(main_file, mask_file):
-    main_nii = nb.load(main_file)
-    main_data = main_nii.get_data()
+    main_data = load_image_data(main_file)
     nan_mask = np.logical_not(np.isnan(main_data))
-    mask = nb.load(mask_file).get_data() > 0
+    mask = load_image_data(mask_file) > 0
 
     data = main_data[np.logical_and(nan_mask, mask)]
     return data
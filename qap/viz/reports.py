@@ -23,8 +23,23 @@ from .plotting import (plot_measures, plot_mosaic, plot_all,
 # matplotlib.rc('figure', figsize=(11.69, 8.27))  # for DINA4 size
 
 
+def _read_measures(in_csv):
+    # Read csv file, sort and drop duplicates
+    df = pd.read_csv(in_csv, dtype={'subject': str}).sort(
+        columns=['subject', 'session', 'scan'])
+
+    try:
+        df.drop_duplicates(['subject', 'session', 'scan'], keep='last',
+                           inplace=True)
+    except TypeError:
+        df.drop_duplicates(['subject', 'session', 'scan'], take_last=True,
+                           inplace=True)
+
+    return df
+
+
 def workflow_report(in_csv, qap_type, run_name, res_dict,
-                    out_dir=None, out_file=None):
+                    out_dir=None, out_file=None, subject_parts=None):
     import datetime
 
     if out_dir is None:
@@ -34,16 +49,10 @@ def workflow_report(in_csv, qap_type, run_name, res_dict,
         out_file = op.join(
             out_dir, qap_type + '_%s.pdf')
 
-    # Read csv file, sort and drop duplicates
-    df = pd.read_csv(in_csv, dtype={'subject': str}).sort(
-        columns=['subject', 'session', 'scan'])
+    if subject_parts is None:
+        subject_parts = {}
 
-    try:
-        df.drop_duplicates(['subject', 'session', 'scan'], keep='last',
-                           inplace=True)
-    except TypeError:
-        df.drop_duplicates(['subject', 'session', 'scan'], take_last=True,
-                           inplace=True)
+    df = _read_measures(in_csv)
 
     subject_list = sorted(pd.unique(df.subject.ravel()))
     result = {}
@@ -84,64 +93,106 @@ def workflow_report(in_csv, qap_type, run_name, res_dict,
         concat_pdf(pdf_group, out_group_file)
         result['group'] = {'success': True, 'path': out_group_file}
 
-    # Generate individual reports for subjects
+    # Generate individual reports for subjects, reusing the parts already
+    # written while the run was going
     for subid in subject_list:
-        # Get subject-specific info
-        subdf = df.loc[df['subject'] == subid]
-        sessions = sorted(pd.unique(subdf.session.ravel()))
-        plots = []
-        sess_scans = []
-        # Re-build mosaic location
-        for sesid in sessions:
-            sesdf = subdf.loc[subdf['session'] == sesid]
-            scans = sorted(pd.unique(sesdf.scan.ravel()))
-
-            # Each scan has a volume and (optional) fd plot
-            for scanid in scans:
-                sub_info = [subid, sesid, scanid]
-                sub_path = op.join(out_dir, run_name, '/'.join(sub_info))
-                m = op.join(sub_path, 'qap_mosaic', 'mosaic.pdf')
-
-                if op.isfile(m):
-                    plots.append(m)
-
-                fd = op.join(sub_path, 'qap_fd', 'fd.pdf')
-                if 'functional_temporal' in qap_type and op.isfile(fd):
-                    plots.append(fd)
-
-            sess_scans.append('%s (%s)' % (sesid, ', '.join(scans)))
-
-        failed = ['%s (%s)' % (s['session'], s['scan'])
-                  for s in res_dict if 'failed' in s['status'] and
-                  subid in s['id']]
-
-        # Summary cover
-        out_sum = op.join(out_dir, run_name, 'summary_%s.pdf' % subid)
-        summary_cover(
-            (subid, subid, qap_type,
-             datetime.datetime.now().strftime("%Y-%m-%d, %H:%M"),
-             ", ".join(sess_scans),
-             ",".join(failed) if len(failed) > 0 else "none"),
-            out_file=out_sum)
-        plots.insert(0, out_sum)
-
-        # Summary (violinplots) of QC measures
-        qc_ms = op.join(out_dir, run_name, subid, 'qc_measures.pdf')
-
-        func(df, subject=subid, out_file=qc_ms)
-        plots.append(qc_ms)
-
-        if len(plots) > 0:
-            if doc is not None:
-                plots.append(doc)
-
-            # Generate final report with collected pdfs in plots
-            sub_path = out_file % subid
-            concat_pdf(plots, sub_path)
-            result[subid] = {'success': True, 'path': sub_path}
+        result[subid] = _subject_report(df, qap_type, run_name, subid,
+                                        res_dict, out_dir, out_file, doc,
+                                        subject_parts.get(subid))
     return result
 
 
+def subject_report(qap_type, run_name, subid, res_dict, out_dir=None):
+    """
+    Write the parts of the individual report of one subject that only
+    depend on the subject (the cover, the mosaics and the FD plots), as
+    soon as all of its scans are done.
+
+    The measures of the subject are compared to the whole group, so that
+    page and the final report are written by workflow_report once the run
+    is done and the measures of every subject are in.
+    """
+
+    if out_dir is None:
+        out_dir = os.getcwd()
+
+    scans = [(s['session'], s['scan']) for s in res_dict
+             if s['id'] == subid and 'failed' not in s['status']]
+
+    return {'success': True,
+            'parts': _subject_parts(qap_type, run_name, subid, scans,
+                                    res_dict, out_dir)}
+
+
+def _subject_parts(qap_type, run_name, subid, scans, res_dict, out_dir):
+    import datetime
+
+    plots = []
+    sess_scans = []
+    # Re-build mosaic location
+    for sesid in sorted(set([s[0] for s in scans])):
+        ses_scans = sorted(set([s[1] for s in scans if s[0] == sesid]))
+
+        # Each scan has a volume and (optional) fd plot
+        for scanid in ses_scans:
+            sub_info = [subid, sesid, scanid]
+            sub_path = op.join(out_dir, run_name, '/'.join(sub_info))
+            m = op.join(sub_path, 'qap_mosaic', 'mosaic.pdf')
+
+            if op.isfile(m):
+                plots.append(m)
+
+            fd = op.join(sub_path, 'qap_fd', 'fd.pdf')
+            if 'functional_temporal' in qap_type and op.isfile(fd):
+                plots.append(fd)
+
+        sess_scans.append('%s (%s)' % (sesid, ', '.join(ses_scans)))
+
+    failed = ['%s (%s)' % (s['session'], s['scan'])
+              for s in res_dict if 'failed' in s['status'] and
+              subid in s['id']]
+
+    # Summary cover
+    out_sum = op.join(out_dir, run_name, 'summary_%s.pdf' % subid)
+    summary_cover(
+        (subid, subid, qap_type,
+         datetime.datetime.now().strftime("%Y-%m-%d, %H:%M"),
+         ", ".join(sess_scans),
+         ",".join(failed) if len(failed) > 0 else "none"),
+        out_file=out_sum)
+    plots.insert(0, out_sum)
+
+    return plots
+
+
+def _subject_report(df, qap_type, run_name, subid, res_dict, out_dir,
+                    out_file, doc, parts=None):
+
+    func = getattr(sys.modules[__name__], qap_type)
+
+    # Get subject-specific info, unless its parts are already written
+    if parts is None:
+        subdf = df.loc[df['subject'] == subid]
+        scans = list(zip(subdf.session, subdf.scan))
+        parts = _subject_parts(qap_type, run_name, subid, scans, res_dict,
+                               out_dir)
+    plots = list(parts)
+
+    # Summary (violinplots) of QC measures
+    qc_ms = op.join(out_dir, run_name, subid, 'qc_measures.pdf')
+
+    func(df, subject=subid, out_file=qc_ms)
+    plots.append(qc_ms)
+
+    if doc is not None:
+        plots.append(doc)
+
+    # Generate final report with collected pdfs in plots
+    sub_path = out_file % subid
+    concat_pdf(plots, sub_path)
+    return {'success': True, 'path': sub_path}
+
+
 def get_documentation(doc_type, out_file):
     import codecs
     import StringIO